@@ -17,18 +17,65 @@ __all__ = ["SimpleHTTPRequestHandler"]
 __author__ = "bones7456"
 __home_page__ = "http://li2z.cn/"
 
+import argparse
+import atexit
+import asyncio
+import base64
+import cProfile
 import os
 import posixpath
 import http.server
+import socketserver
+import stat
+import threading
+import time
 import urllib.request
 import urllib.parse
 import urllib.error
-import cgi
+import datetime
+import email.utils
+import errno
+import gzip
+import hashlib
+import html
+import io
+import itertools
+import json
 import shutil
 import mimetypes
+import pstats
+import queue
 import re
+import socket
+import sys
+import tarfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
+# Optional modules for more content encodings.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional module for fast non-cryptographic upload digests.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Optional module for image thumbnails.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
 
 class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
@@ -46,12 +93,254 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
     server_version = "SimpleHTTPWithUpload/" + __version__
 
+    # How much of a PUT body to read (and write) at once.
+    put_bufsize = 1024 * 1024
+
+    # When uploaded files are synced to disk, see AtomicFile.
+    fsync_policy = "none"
+
+    # Digests computed for every uploaded file, see new_hash().
+    digest_algorithms = ()
+
+    # Uploads are refused if they would leave less than min_free_space
+    # bytes free on the file system, or exceed one of the quotas (a
+    # DirectoryQuotas object), see admit_upload().
+    min_free_space = 0
+    quotas = None
+
+    # RateLimiters for traffic to and from clients, if any.
+    download_limiter = None
+    upload_limiter = None
+
+    # Metrics served at metrics_path, and RequestProfiler, if enabled.
+    metrics = None
+    metrics_path = "/__metrics"
+    profiler = None
+    status_code = None
+
+    # AccessLog receiving a JSON record per request, instead of the
+    # usual log lines on stderr.
+    access_log = None
+
+    # Keep connections open between requests; every response must
+    # then have either a Content-Length or a chunked body.
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are written separately, so on a kept-alive
+    # connection Nagle's algorithm would hold back the body until the
+    # client's delayed ACK, adding ~40ms to every small response.
+    disable_nagle_algorithm = True
+
+    # Don't let a stalled client hold a connection forever.
+    timeout = 60
+
+    # How long a persistent connection may wait for its next request.
+    # It holds a thread meanwhile, so this is much shorter than timeout.
+    idle_timeout = 5
+
+    # Serve regular files with the sendfile() system call.
+    use_sendfile = True
+
+    # Value of the Cache-Control header sent with files, if any.
+    cache_control = None
+
+    # LRUCache of rendered directory listings, and how many entries
+    # to show per page (0 means everything in one page).
+    listing_cache = None
+    listing_page_size = 5000
+
+    # LRUCache of resolved request paths, see resolve_path().
+    path_cache = None
+
+    # ContentCache holding small files in memory, if any.
+    content_cache = None
+
+    # Thumbnailer making the previews of the thumbnail view, if any.
+    thumbnailer = None
+
+    # Threads used to compress tar.zst directory archives.
+    archive_threads = 0
+    # Archive members up to this size are read before being added, so
+    # they can still be left out if that fails.
+    archive_buffer_size = 1024 * 1024
+
+    # CompressionCache used to compress files on the fly, if any.
+    compression_cache = None
+    compress_min_size = 1024
+    # Larger files are sent uncompressed, rather than tying up a
+    # thread compressing them (and filling the cache).
+    compress_max_size = 64 * 1024 * 1024
+    compressible_types = {
+        "application/javascript",
+        "application/json",
+        "application/xml",
+        "image/svg+xml",
+    }
+
+    # Set by send_head() when an error response doesn't need to close
+    # the connection.
+    error_keeps_alive = False
+
+    # Set by send_header() once this response has "Connection: close".
+    close_sent = False
+
+    def setup(self):
+        super().setup()
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        self.counting = self.metrics is not None or self.access_log is not None
+        if self.counting:
+            self.wfile = CountingWriter(self.wfile, self.count_sent)
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+
+    def handle_one_request(self):
+        """Handle one request, collecting metrics, profiles and access
+        log records if enabled."""
+        # Until the request line arrives; parse_request() restores it.
+        self.connection.settimeout(self.idle_timeout)
+        if (self.metrics is None and self.profiler is None
+                and self.access_log is None):
+            super().handle_one_request()
+            return
+        # Left over from the previous request otherwise.
+        self.command = None
+        self.status_code = None
+        self.request_bytes_in = 0
+        self.response_bytes_out = 0
+        self.request_started = self.response_started = time.monotonic()
+        if self.profiler is not None:
+            self.profiler.run(super().handle_one_request)
+        else:
+            super().handle_one_request()
+        if not self.status_code:
+            return
+        duration = time.monotonic() - self.request_started
+        if self.metrics is not None and self.command:
+            self.metrics.observe_request(self.command, self.status_code,
+                                         duration, self.request_bytes_in)
+        if self.access_log is not None:
+            self.access_log.log({
+                "time": round(time.time() - duration, 3),
+                "client": self.client_address[0],
+                "method": self.command,
+                "path": self.path,
+                "protocol": self.request_version,
+                "status": self.status_code,
+                "bytes_in": self.request_bytes_in,
+                "bytes_out": self.response_bytes_out,
+                "response_ms": round(
+                    (self.response_started - self.request_started) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                "user_agent": self.headers.get("User-Agent")
+                if self.command else None,
+            })
+
+    def log_request(self, code='-', size='-'):
+        if isinstance(code, http.HTTPStatus):
+            code = code.value
+        self.status_code = code
+        if self.access_log is not None:
+            # The record is written by handle_one_request(), once the
+            # response is complete.
+            self.response_started = time.monotonic()
+            return
+        super().log_request(code, size)
+
+    def log_message(self, format, *args):
+        """Log a message, to the access log if there is one."""
+        if self.access_log is None:
+            super().log_message(format, *args)
+            return
+        self.access_log.log({
+            "time": round(time.time(), 3),
+            "client": self.client_address[0],
+            "message": format % args,
+        })
+
+    def count_sent(self, nbytes):
+        self.response_bytes_out += nbytes
+        if self.metrics is not None:
+            self.metrics.count_sent(nbytes)
+
+    def count_received(self, nbytes):
+        self.request_bytes_in += nbytes
+        if self.metrics is not None:
+            self.metrics.count_received(nbytes)
+
+    def send_metrics(self):
+        """Send the metrics in the Prometheus text format."""
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        return BytesIO(body)
+
+    def parse_request(self):
+        self.error_keeps_alive = False
+        self.upload_admitted = False
+        self.content_length = None
+        self.connection.settimeout(self.timeout)
+        # Measure from here, not from the wait for the request line.
+        self.request_started = time.monotonic()
+        return super().parse_request()
+
+    def send_error(self, code, message=None, explain=None):
+        """Send an error reply, keeping the connection open if possible.
+
+        The base class always closes the connection after an error,
+        which is only needed when the request could not be parsed or
+        its body was not read.
+
+        """
+        try:
+            super().send_error(code, message, explain)
+        finally:
+            self.error_keeps_alive = False
+
+    def send_response(self, code, message=None):
+        self.close_sent = False
+        super().send_response(code, message)
+        busy = getattr(self.server, "busy", None)
+        if not self.close_connection and busy is not None and busy():
+            # Give this connection's thread to the clients waiting for
+            # one, rather than keep it for this client's next request.
+            self.error_keeps_alive = False
+            self.send_header("Connection", "close")
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "connection" and value.lower() == "close":
+            if self.error_keeps_alive or self.close_sent:
+                return
+            self.close_sent = True
+        if keyword.lower() == "content-length":
+            # The body must not go beyond this, even if the file grows
+            # meanwhile, or it would corrupt the next response.
+            self.content_length = int(value)
+        super().send_header(keyword, value)
+
     def do_GET(self):
         """Serve a GET request."""
         f = self.send_head()
         if f:
-            self.copyfile(f, self.wfile)
-            f.close()
+            try:
+                if self.byteranges:
+                    self.copy_byteranges(f, self.wfile)
+                elif self.chunked:
+                    out = ChunkedWriter(self.wfile)
+                    self.copyfile(f, out)
+                    out.finish()
+                else:
+                    self.copyfile(f, self.wfile, self.content_length)
+            finally:
+                f.close()
 
     def do_HEAD(self):
         """Serve a HEAD request."""
@@ -59,10 +348,111 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         if f:
             f.close()
 
+    def handle_expect_100(self):
+        """Refuse uploads that don't fit before the client sends them."""
+        if self.command in ("POST", "PUT") and not self.admit_upload():
+            return False
+        return super().handle_expect_100()
+
+    def admit_upload(self):
+        """Check whether the body of this upload request can be stored.
+
+        The size of the upload is taken from the request headers, so
+        this is done before reading the body.  If storing it would
+        leave less than min_free_space bytes free on the file system, a
+        507 error is sent; if it would exceed a directory quota, a 413
+        error is sent.  Return value is False if an error was sent.
+
+        Uploads of unknown length (with the chunked transfer coding)
+        are checked again as their body is read, see request_body().
+
+        """
+        if self.upload_admitted:
+            return True
+        directory, size = self.upload_destination()
+        try:
+            self.reserve_space(directory, size)
+        except UploadRefused as e:
+            self.send_error(e.code, str(e))
+            return False
+        self.upload_directory = directory
+        self.upload_received = 0
+        self.upload_admitted = True
+        return True
+
+    def reserve_received(self, size):
+        """Account for SIZE more bytes of an upload of unknown length.
+
+        If that is refused, what the upload reserved so far is released,
+        as its file is not kept.
+
+        """
+        try:
+            self.reserve_space(self.upload_directory, size)
+        except UploadRefused:
+            if self.quotas is not None:
+                self.quotas.release(self.upload_directory,
+                                    self.upload_received)
+            raise
+        self.upload_received += size
+
+    def reserve_space(self, directory, size):
+        """Account for SIZE more bytes uploaded to DIRECTORY.
+
+        Raises UploadRefused if that would leave less than
+        min_free_space bytes free on the file system, or exceed a
+        directory quota.
+
+        """
+        try:
+            st = os.statvfs(directory)
+        except (AttributeError, OSError):
+            # No statvfs() here, or a missing directory, which is
+            # reported once the upload is attempted.
+            st = None
+        if (st is not None and
+                st.f_bavail * st.f_frsize - size < self.min_free_space):
+            raise UploadRefused(507, "Not enough free disk space")
+        if self.quotas is not None and not self.quotas.reserve(directory,
+                                                               size):
+            raise UploadRefused(413, "Upload would exceed the directory quota")
+
+    def upload_destination(self):
+        """Return the directory this upload request writes to, and the
+        number of bytes it will add there."""
+        path = self.translate_path(self.path)
+        try:
+            size = max(int(self.headers.get("Content-Length", "0")), 0)
+        except ValueError:
+            size = 0
+        if self.command == "POST":
+            return path, size
+        if "Content-Range" in self.headers:
+            # Space for the whole file is taken by its first part.
+            try:
+                size = parse_content_range(self.headers["Content-Range"])[2]
+            except ValueError:
+                size = 0
+            if ResumableUpload(path).size() is not None:
+                size = 0
+        return os.path.dirname(path), size
+
     def do_POST(self):
         """Serve a POST request."""
-        r, info = self.deal_post_data()
-        print((r, info, "by: ", self.client_address))
+        self.upload_digests = []
+        if not self.admit_upload():
+            return
+        try:
+            r, info = self.deal_post_data()
+        except UploadRefused as e:
+            self.log_message("Upload failed: %s", e)
+            self.send_error(e.code, str(e))
+            return
+        self.log_message("Upload %s: %s", "succeeded" if r else "failed",
+                         info)
+        if not r:
+            # Part of the request body may still be unread.
+            self.close_connection = True
         f = BytesIO()
         f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
         f.write(b"<html>\n<title>Upload Result Page</title>\n")
@@ -82,53 +472,277 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.send_header("Content-Length", str(length))
+        for fn, digests in self.upload_digests:
+            self.send_header("X-Upload-Digest", "%s; %s" % (
+                urllib.parse.quote(os.path.basename(fn)),
+                format_digest_header(digests)))
         self.end_headers()
         if f:
-            self.copyfile(f, self.wfile)
+            self.copyfile(f, self.wfile, length)
             f.close()
 
+    def do_DELETE(self):
+        """Serve a DELETE request.
+
+        Only the cancellation of a resumable upload is supported, with
+        an "upload" query parameter; see put_part().
+
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query,
+                                      keep_blank_values=True)
+        if "upload" not in query:
+            self.send_error(501, "Unsupported method ('DELETE')")
+            return
+        if not ResumableUpload(self.translate_path(self.path)).cancel():
+            self.send_error(404, "No upload in progress")
+            return
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        """Serve a PUT request.
+
+        The request body is stored as it is at the request path.  It is
+        first written to a temporary file, which replaces the target
+        only once the whole body was received.
+
+        If the client sends a Digest header (RFC 3230), the file is only
+        stored if its digests match.  The digests computed while
+        writing are sent back in a Digest header.
+
+        With a Content-Range header, the body is a single part of a
+        resumable upload instead, see put_part().
+
+        """
+        path = self.translate_path(self.path)
+        if self.path.split('?', 1)[0].endswith('/') or os.path.isdir(path):
+            self.send_error(405, "Can't PUT a directory")
+            return
+        if not self.admit_upload():
+            return
+        if "Content-Range" in self.headers:
+            self.put_part(path)
+            return
+        existed = os.path.exists(path)
+        try:
+            body = self.request_body()
+            expected = parse_digest_header(self.headers.get("Digest", ""))
+        except ValueError as e:
+            self.send_error(411 if "Missing" in str(e) else 400, str(e))
+            return
+        algorithms = set(self.digest_algorithms) | set(expected)
+        try:
+            with AtomicFile(path, self.body_length, self.fsync_policy,
+                            algorithms) as out:
+                for data in iter(lambda: body.read(self.put_bufsize), b""):
+                    out.write(data)
+                digests = {name: h.digest() for name, h in out.hashes.items()}
+                for name, value in expected.items():
+                    if digests[name] != value:
+                        raise ValueError("Digest mismatch for %s" % name)
+                out.commit()
+        except UploadRefused as e:
+            self.send_error(e.code, str(e))
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except FileNotFoundError:
+            self.send_error(409, "Parent directory does not exist")
+            return
+        except OSError:
+            self.send_error(403, "Can't create file to write, do you have permission to write?")
+            return
+        self.send_response(204 if existed else 201)
+        if digests:
+            self.send_header("Digest", format_digest_header(digests))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def put_part(self, path):
+        """Store one part of a resumable upload of PATH.
+
+        The part goes at the position given by the Content-Range
+        header, and must be exactly as long as that range.  Parts can
+        be sent in any order, in parallel, and sent again after a
+        failure; see ResumableUpload.  All the parts of an upload
+        should have the same X-Upload-Id header, so that they are not
+        mixed with those of another upload of PATH.
+
+        While parts are missing, the response is 202, with the ranges
+        received so far in an X-Upload-Received header (in the syntax
+        of a Range header).  The part that completes the file gets the
+        same response as a plain PUT.  A GET of PATH with an "upload"
+        query parameter returns the progress of the upload as JSON,
+        and a DELETE cancels it.
+
+        """
+        try:
+            first, last, total = parse_content_range(
+                self.headers["Content-Range"])
+            body = self.request_body()
+        except ValueError as e:
+            self.send_error(411 if "Missing" in str(e) else 400, str(e))
+            return
+        if self.body_length != last - first + 1:
+            self.send_error(400, "Content-Range doesn't match the body length")
+            return
+        upload_id = self.headers.get("X-Upload-Id", "").strip()
+        if not re.fullmatch(r"[!-~]{0,256}", upload_id):
+            self.send_error(400, "Invalid X-Upload-Id header")
+            return
+        upload = ResumableUpload(path, upload_id)
+        existed = os.path.exists(path)
+        try:
+            written = upload.write_part(first, total, body, self.put_bufsize,
+                                        self.fsync_policy)
+            if written is None:
+                # A copy of a part of the upload that just finished.
+                finished = True
+            elif written != last - first + 1:
+                self.send_error(400, "Incomplete part")
+                return
+            else:
+                finished = upload.add_part(first, last, self.fsync_policy)
+        except ValueError as e:
+            self.send_error(409, str(e))
+            return
+        except FileNotFoundError:
+            self.send_error(409, "Parent directory does not exist")
+            return
+        except OSError:
+            self.send_error(403, "Can't create file to write, do you have permission to write?")
+            return
+        if finished:
+            self.send_response(204 if existed else 201)
+        else:
+            self.send_response(202)
+            self.send_header("X-Upload-Received", "bytes=" + ",".join(
+                "%d-%d" % r for r in upload.received()))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
     def deal_post_data(self):
-        content_type = self.headers['content-type']
-        if not content_type:
+        if self.headers.get_content_type() != "multipart/form-data":
+            return (False, "Content-Type is not multipart/form-data")
+        boundary = self.headers.get_param("boundary")
+        if not boundary:
             return (False, "Content-Type header doesn't contain boundary")
-        boundary = content_type.split("=")[1].encode()
-        remainbytes = int(self.headers['content-length'])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        if boundary not in line:
-            return (False, "Content NOT begin with boundary")
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        fn = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', line.decode())
-        if not fn:
-            return (False, "Can't find out file name...")
+        try:
+            body = self.request_body()
+        except ValueError as e:
+            return (False, str(e))
+        reader = MultipartReader(body, boundary.encode())
         path = self.translate_path(self.path)
-        fn = os.path.join(path, fn[0])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        try:
-            out = open(fn, 'wb')
-        except IOError:
-            return (False, "Can't create file to write, do you have permission to write?")
-
-        preline = self.rfile.readline()
-        remainbytes -= len(preline)
-        while remainbytes > 0:
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            if boundary in line:
-                preline = preline[0:-1]
-                if preline.endswith(b'\r'):
-                    preline = preline[0:-1]
-                out.write(preline)
-                out.close()
-                return (True, "File '%s' upload success!" % fn)
-            else:
-                out.write(preline)
-                preline = line
-        return (False, "Unexpect Ends of data.")
+        uploaded = []
+        try:
+            while True:
+                headers = reader.next_part()
+                if headers is None:
+                    break
+                fn = re.findall(r'filename="(.*)"',
+                                headers.get("content-disposition", ""))
+                if not fn or not fn[0]:
+                    # A regular form field, or an empty file input.
+                    continue
+                name = os.path.basename(fn[0])
+                if name in ("", ".", ".."):
+                    return (False, "Invalid file name: %s" % html.escape(fn[0]))
+                fn = os.path.join(path, name)
+                size = None
+                if self.body_length is not None:
+                    # What is left of the body bounds the part size.
+                    size = body.length_hint() + len(reader.buf)
+                try:
+                    out = AtomicFile(fn, size, self.fsync_policy,
+                                     self.digest_algorithms)
+                except IOError:
+                    return (False, "Can't create file to write, do you have permission to write?")
+                try:
+                    with out:
+                        reader.read_part(out.write)
+                        out.commit()
+                except OSError as e:
+                    return (False, "Can't write file %s: %s" % (
+                        html.escape(fn), html.escape(e.strerror or str(e))))
+                uploaded.append(fn)
+                if out.hashes:
+                    self.upload_digests.append((fn, {
+                        name: h.digest() for name, h in out.hashes.items()}))
+            # Skip the epilogue, so the connection can be reused.
+            while reader.fp.read(64 * 1024):
+                pass
+        except UploadRefused:
+            raise
+        except ValueError as e:
+            return (False, str(e))
+        if not uploaded:
+            return (False, "Can't find out file name...")
+        info = ["File '%s' upload success!" % html.escape(fn)
+                for fn in uploaded]
+        for fn, digests in self.upload_digests:
+            info.append("%s: %s" % (html.escape(fn), " ".join(
+                "%s=%s" % (name, value.hex())
+                for name, value in sorted(digests.items()))))
+        return (True, "<br>".join(info))
+
+    def request_body(self):
+        """Return a file-like object to read the request body from.
+
+        See open_request_body() for the details; this also applies the
+        upload rate limits and counts the bytes received, if enabled.
+
+        If the length of an admitted upload is not known in advance,
+        the free space and quotas are checked as its body is read, and
+        read() raises UploadRefused once they are exceeded.
+
+        """
+        body = self.open_request_body()
+        if self.body_length is None and self.upload_admitted:
+            body = CountingReader(body, self.reserve_received)
+        if self.counting:
+            body = CountingReader(body, self.count_received)
+        if self.upload_limiter is not None:
+            body = ThrottledReader(body, self.upload_limiter,
+                                   self.client_address[0])
+        return body
+
+    def open_request_body(self):
+        """Return a file-like object to read the request body from.
+
+        The body may have a Content-Length, use the chunked transfer
+        coding, or (for HTTP/1.0 clients only) simply last until the
+        client closes its side of the connection.  Its read() returns
+        data as soon as it arrives, not necessarily as many bytes as
+        requested, and b"" at the end of the body.
+
+        Sets self.body_length to the length of the body, or None if it
+        is not known in advance.  Raises ValueError if the framing of
+        the body is not supported.
+
+        """
+        self.body_length = None
+        transfer_encoding = self.headers.get("Transfer-Encoding")
+        if transfer_encoding is not None:
+            if transfer_encoding.strip().lower() != "chunked":
+                raise ValueError("Unsupported Transfer-Encoding: %s"
+                                 % transfer_encoding)
+            return ChunkedReader(self.rfile)
+        content_length = self.headers.get("Content-Length")
+        if content_length is not None:
+            try:
+                length = int(content_length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise ValueError("Invalid Content-Length header")
+            self.body_length = length
+            return LimitedReader(self.rfile, length)
+        if self.request_version >= "HTTP/1.1":
+            raise ValueError("Missing Content-Length header")
+        self.close_connection = True
+        return LimitedReader(self.rfile, float("inf"))
 
     def send_head(self):
         """Common code for GET and HEAD commands.
@@ -141,39 +755,452 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         None, in which case the caller has nothing further to do.
 
         """
-        path = self.translate_path(self.path)
+        path, isdir, target, ctype = self.resolve_path(self.path)
         f = None
-        if os.path.isdir(path):
-            if not self.path.endswith('/'):
+        self.byteranges = None
+        self.chunked = False
+        self.error_keeps_alive = ("Content-Length" not in self.headers and
+                                  "Transfer-Encoding" not in self.headers)
+        parts = urllib.parse.urlsplit(self.path)
+        if self.metrics is not None and parts.path == self.metrics_path:
+            return self.send_metrics()
+        query = urllib.parse.parse_qs(parts.query, keep_blank_values=True)
+        if isdir:
+            if not parts.path.endswith('/'):
                 # redirect browser - doing basically what apache does
                 self.send_response(301)
-                self.send_header("Location", self.path + "/")
+                self.send_header("Location", urllib.parse.urlunsplit(
+                    parts._replace(path=parts.path + "/")))
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
-            for index in "index.html", "index.htm":
-                index = os.path.join(path, index)
-                if os.path.exists(index):
-                    path = index
-                    break
-            else:
+            if "archive" in query:
+                return self.send_archive(path, query["archive"][0])
+            if "upload" in query:
+                return self.send_upload_page()
+            if target is None:
                 return self.list_directory(path)
-        ctype = self.guess_type(path)
+        elif "upload" in query:
+            return self.send_upload_status(path)
+        elif "thumbnail" in query and self.thumbnailer is not None:
+            return self.send_thumbnail(path)
+        path = target
+        cached = None
+        if self.content_cache is not None:
+            cached = self.content_cache.get(path)
+        if cached is not None:
+            fs, data = cached
+            f = BytesIO(data)
+        else:
+            try:
+                # Always read in binary mode. Opening files in text mode may cause
+                # newline translations, making the actual size of the content
+                # transmitted *less* than the content-length!
+                f = open(path, 'rb')
+            except IOError:
+                self.send_error(404, "File not found")
+                return None
+            fs = os.fstat(f.fileno())
+            if self.content_cache is not None:
+                data = self.content_cache.load(path, f, fs)
+                if data is not None:
+                    f.close()
+                    f = BytesIO(data)
+        size = fs.st_size
+        encoding = encoded = None
+        if "Accept-Encoding" in self.headers:
+            chosen = self.choose_encoding(path, fs, ctype)
+            if chosen is not None:
+                encoding, encoded = chosen
+        last_modified = self.date_time_string(fs.st_mtime)
+        etag = file_etag(fs, encoding)
+        if self.not_modified(fs, etag):
+            f.close()
+            if encoded is not None:
+                encoded.close()
+            self.send_response(304)
+            self.send_validators(etag, last_modified)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return None
+        if encoding and encoded is None:
+            # Only compress now that the response has a body; for HEAD,
+            # only an already compressed copy gives the length.
+            encoded = self.compressed_copy(path, fs, encoding,
+                                           self.command != "HEAD")
+            if encoded is None and self.command != "HEAD":
+                encoding = None
+                etag = file_etag(fs, encoding)
+        if encoded is not None:
+            f.close()
+            f = encoded
+            size = os.fstat(f.fileno()).st_size
+        elif encoding:
+            size = None
+        ranges = None
+        if "Range" in self.headers and size is not None:
+            if_range = self.headers.get("If-Range")
+            if if_range is None or if_range in (etag, last_modified):
+                ranges = parse_byte_ranges(self.headers["Range"], size)
+        if ranges == []:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if ranges:
+            self.send_response(206)
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Range",
+                                 "bytes %d-%d/%d" % (start, end, size))
+                self.send_header("Content-Length", str(end - start + 1))
+                self.byteranges = ([(b"", start, end - start + 1)], b"")
+            else:
+                boundary = os.urandom(16).hex()
+                parts = []
+                length = 0
+                for start, end in ranges:
+                    header = ("\r\n--%s\r\nContent-Type: %s\r\n"
+                              "Content-Range: bytes %d-%d/%d\r\n\r\n"
+                              % (boundary, ctype, start, end, size)).encode()
+                    parts.append((header, start, end - start + 1))
+                    length += len(header) + end - start + 1
+                trailer = ("\r\n--%s--\r\n" % boundary).encode()
+                length += len(trailer)
+                self.send_header("Content-type",
+                                 "multipart/byteranges; boundary=" + boundary)
+                self.send_header("Content-Length", str(length))
+                self.byteranges = (parts, trailer)
+        else:
+            self.send_response(200)
+            self.send_header("Content-type", ctype)
+            if size is not None:
+                self.send_header("Content-Length", str(size))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_validators(etag, last_modified)
+        self.end_headers()
+        return f
+
+    def send_thumbnail(self, path):
+        """Send a JPEG preview of the image PATH, see Thumbnailer."""
         try:
-            # Always read in binary mode. Opening files in text mode may cause
-            # newline translations, making the actual size of the content
-            # transmitted *less* than the content-length!
-            f = open(path, 'rb')
-        except IOError:
+            fs = os.stat(path)
+        except OSError:
             self.send_error(404, "File not found")
             return None
+        etag = '"%x-%x-%x-thumb%d"' % (fs.st_ino, fs.st_size, fs.st_mtime_ns,
+                                       self.thumbnailer.size)
+        last_modified = self.date_time_string(fs.st_mtime)
+        if self.not_modified(fs, etag):
+            self.send_response(304)
+            self.send_validators(etag, last_modified)
+            self.end_headers()
+            return None
+        try:
+            f = open(self.thumbnailer.get(path, fs), 'rb')
+        except (OSError, ValueError, Image.DecompressionBombError):
+            self.send_error(415, "Can't make a thumbnail of this file")
+            return None
         self.send_response(200)
-        self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_header("Content-type", "image/jpeg")
+        self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+        self.send_validators(etag, last_modified)
         self.end_headers()
         return f
 
+    def send_upload_status(self, path):
+        """Send the progress of a resumable upload of PATH as JSON."""
+        upload = ResumableUpload(path)
+        size = upload.size()
+        if size is None:
+            self.send_error(404, "No upload in progress")
+            return None
+        body = json.dumps({
+            "size": size,
+            "id": upload.stored_id(),
+            "received": upload.received(),
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return BytesIO(body)
+
+    def send_upload_page(self):
+        """Send a page that uploads many files with resumable uploads."""
+        displaypath = html.escape(
+            urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        body = (UPLOAD_PAGE % {"path": displaypath}).encode()
+        self.send_response(200)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return BytesIO(body)
+
+    def choose_encoding(self, path, fs, ctype):
+        """Choose a compressed version of PATH that the client accepts.
+
+        A precompressed sibling file (such as PATH + ".gz") is used if
+        it is not older than PATH.  Otherwise, compressible files can
+        be compressed into the compression cache, if there is one, but
+        that is left to compressed_copy().
+
+        Return value is an (encoding, file object) tuple, where the
+        file object is None if PATH has to be compressed on the fly;
+        or None if PATH should be sent as it is.
+
+        """
+        accepted = parse_accept_encoding(self.headers["Accept-Encoding"])
+
+        def quality(enc):
+            return accepted.get(enc[0], accepted.get("*", 0))
+
+        candidates = [enc for enc in CONTENT_ENCODINGS if quality(enc) > 0]
+        # sort() is stable, so ties keep the server preference order.
+        candidates.sort(key=quality, reverse=True)
+        for encoding, suffix, compress in candidates:
+            try:
+                f = open(path + suffix, 'rb')
+            except IOError:
+                continue
+            if os.fstat(f.fileno()).st_mtime >= fs.st_mtime:
+                return encoding, f
+            f.close()
+        if (self.compression_cache is None
+                or fs.st_size < self.compress_min_size
+                or fs.st_size > self.compress_max_size
+                or not self.is_compressible(ctype)):
+            return None
+        for encoding, suffix, compress in candidates:
+            if compress is not None:
+                return encoding, None
+        return None
+
+    def compressed_copy(self, path, fs, encoding, create=True):
+        """Open the copy of PATH compressed with ENCODING, from the
+        compression cache.
+
+        If CREATE is true, the copy is made if it is not cached yet.
+        Return value is None if there is no copy, or it can't be made.
+
+        """
+        for name, suffix, compress in CONTENT_ENCODINGS:
+            if name == encoding:
+                break
+        try:
+            if create:
+                filename = self.compression_cache.get(path, fs, suffix,
+                                                      compress)
+            else:
+                filename = self.compression_cache.lookup(path, fs, suffix)
+                if filename is None:
+                    return None
+            return open(filename, 'rb')
+        except IOError as e:
+            self.log_error("Could not compress %s: %s", path, e)
+            return None
+
+    def not_modified(self, fs, etag):
+        """Check the conditional request headers against a file.
+
+        Return True if the client's cached copy, described by
+        If-None-Match or If-Modified-Since, is still current.
+
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # Weak comparison, as required for If-None-Match.
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in (
+                tag[2:] if tag.startswith("W/") else tag for tag in tags)
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            # Last-Modified has only one second of precision.
+            return int(fs.st_mtime) <= since.timestamp()
+        return False
+
+    def send_validators(self, etag, last_modified):
+        """Send the caching related headers for a file response."""
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if self.cache_control:
+            self.send_header("Cache-Control", self.cache_control)
+
+    def is_compressible(self, ctype):
+        """Tell whether files of MIME type CTYPE are worth compressing."""
+        return ctype.startswith("text/") or ctype in self.compressible_types
+
+    def send_archive(self, path, fmt):
+        """Send the directory PATH as an archive built on the fly.
+
+        FMT is one of the keys of ARCHIVE_TYPES.  The archive is not
+        stored anywhere: write_archive() produces it while it is being
+        sent, so the response has no Content-Length.
+
+        """
+        if fmt not in ARCHIVE_TYPES:
+            self.send_error(400, "Unknown archive format")
+            return None
+        if fmt == "tar.zst" and zstandard is None:
+            self.send_error(501, "The zstandard module is not installed")
+            return None
+        name = os.path.basename(os.path.normpath(path)) or "archive"
+        self.send_response(200)
+        self.send_header("Content-type", ARCHIVE_TYPES[fmt])
+        self.send_header("Content-Disposition", "attachment; filename*=UTF-8''%s"
+                         % urllib.parse.quote(name + "." + fmt))
+        self.send_chunked_header()
+        self.end_headers()
+        return DeferredBody(lambda out: self.write_archive(path, fmt, out))
+
+    def write_archive(self, path, fmt, outputfile):
+        """Write an archive of the directory PATH to OUTPUTFILE.
+
+        Only one member is being read at any time, so memory use does
+        not depend on the size of the tree.  In zip archives, members
+        with a compressible MIME type are deflated and the others are
+        stored as they are.  tar.zst archives are compressed by
+        archive_threads threads, if more than one.  Files that cannot
+        be read are left out, and so are the temporary files of
+        uploads in progress.
+
+        """
+        out = io.BufferedWriter(outputfile, 256 * 1024)
+        try:
+            if fmt == "zip":
+                with zipfile.ZipFile(out, "w") as zf:
+                    for fullname, arcname in walk_tree(path):
+                        self.add_to_zip(zf, fullname, arcname)
+            else:
+                if fmt == "tar.zst":
+                    compressor = zstandard.ZstdCompressor(
+                        threads=self.archive_threads
+                        if self.archive_threads > 1 else 0)
+                    target = compressor.stream_writer(out, closefd=False)
+                else:
+                    target = out
+                mode = "w|gz" if fmt == "tar.gz" else "w|"
+                with tarfile.open(fileobj=target, mode=mode,
+                                  format=tarfile.PAX_FORMAT) as tar:
+                    for fullname, arcname in walk_tree(path):
+                        self.add_to_tar(tar, fullname, arcname)
+                if target is not out:
+                    target.close()
+            out.flush()
+        finally:
+            # Don't let the buffer close the connection.
+            try:
+                out.detach()
+            except OSError:
+                pass
+
+    def add_to_zip(self, zf, fullname, arcname):
+        """Add one member to a directory archive, skipping unreadable files.
+
+        Files larger than archive_buffer_size are streamed: if reading
+        them fails midway, the member ends there.
+
+        """
+        try:
+            zinfo = zipfile.ZipInfo.from_file(fullname, arcname)
+            if zinfo.is_dir():
+                zf.writestr(zinfo, b"")
+                return
+            src = open(fullname, 'rb')
+            data = None
+            if zinfo.file_size <= self.archive_buffer_size:
+                with src:
+                    data = src.read()
+        except OSError as e:
+            self.log_error("Skipped in archive: %s", e)
+            return
+        if self.is_compressible(self.guess_type(fullname)):
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        if data is not None:
+            zf.writestr(zinfo, data)
+            return
+        try:
+            with src, zf.open(zinfo, 'w') as dest:
+                shutil.copyfileobj(src, dest, 256 * 1024)
+        except OSError as e:
+            self.log_error("Truncated in archive: %s", e)
+
+    def add_to_tar(self, tar, fullname, arcname):
+        """Add one member to a directory archive, skipping unreadable files.
+
+        The header of a file larger than archive_buffer_size is written
+        before its data is read: if reading fails midway, or the file
+        shrinks meanwhile, the member is padded with NUL bytes to the
+        size in the header, so that the rest of the archive is valid.
+
+        """
+        try:
+            tarinfo = tar.gettarinfo(fullname, arcname)
+            src = None
+            if tarinfo.isreg() and tarinfo.size <= self.archive_buffer_size:
+                with open(fullname, 'rb') as f:
+                    data = f.read(tarinfo.size)
+                tarinfo.size = len(data)
+                src = BytesIO(data)
+            elif tarinfo.isreg():
+                src = open(fullname, 'rb')
+        except OSError as e:
+            self.log_error("Skipped in archive: %s", e)
+            return
+        if src is None:
+            tar.addfile(tarinfo)
+            return
+
+        def truncated(e):
+            self.log_error("Truncated in archive: %s: %s", fullname, e)
+
+        with src:
+            tar.addfile(tarinfo, PaddedReader(src, tarinfo.size, truncated))
+
+    def send_chunked_header(self):
+        """Prepare a response whose length is not known in advance.
+
+        HTTP/1.1 clients get a chunked body (do_GET() takes care of the
+        framing), older ones get a body that ends when the connection
+        is closed.
+
+        """
+        if self.request_version >= "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.chunked = True
+        else:
+            self.close_connection = True
+
+    def copy_byteranges(self, source, outputfile):
+        """Copy the ranges selected by send_head() from SOURCE.
+
+        For a single range only the bytes themselves are written; for
+        several ranges each one is preceded by its multipart/byteranges
+        part header.
+
+        """
+        parts, trailer = self.byteranges
+        for header, start, length in parts:
+            if header:
+                outputfile.write(header)
+            source.seek(start)
+            self.copyfile(source, outputfile, length)
+        if trailer:
+            outputfile.write(trailer)
+
     def list_directory(self, path):
         """Helper to produce a directory listing (absent index.html).
 
@@ -181,43 +1208,250 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         error).  In either case, the headers are sent, making the
         interface the same as for send_head().
 
+        Long listings are split in pages of listing_page_size entries,
+        selected with a "page" query parameter.  The entries come from
+        directory_lines() and are streamed to the client as they are,
+        without joining the whole page in memory.
+
+        With a "format=json" or "format=ndjson" query parameter (or
+        an Accept header asking for either), list_directory_json() is
+        used instead.
+
+        With a "view=thumbnails" query parameter, and a thumbnailer,
+        the entries are shown as a grid of previews, see gallery_lines().
+
         """
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        fmt = self.listing_format(query)
+        if fmt != "html":
+            return self.list_directory_json(path, query, fmt == "ndjson")
+        gallery = (self.thumbnailer is not None and
+                   query.get("view", [""])[0] == "thumbnails")
         try:
-            list = os.listdir(path)
-        except os.error:
+            if gallery:
+                lines = self.gallery_lines(path)
+            else:
+                lines = self.directory_lines(path)
+        except OSError:
             self.send_error(404, "No permission to list directory")
             return None
-        list.sort(key=lambda a: a.lower())
-        f = BytesIO()
-        displaypath = cgi.escape(urllib.parse.unquote(self.path))
-        f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
-        f.write(("<html>\n<title>Directory listing for %s</title>\n" % displaypath).encode())
-        f.write(("<body>\n<h2>Directory listing for %s</h2>\n" % displaypath).encode())
-        f.write(b"<hr>\n")
-        f.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\">")
-        f.write(b"<input name=\"file\" type=\"file\"/>")
-        f.write(b"<input type=\"submit\" value=\"upload\"/></form>\n")
-        f.write(b"<hr>\n<ul>\n")
-        for name in list:
-            fullname = os.path.join(path, name)
+        view = "&view=thumbnails" if gallery else ""
+        page_size = self.listing_page_size
+        pages = max(1, -(-len(lines) // page_size)) if page_size else 1
+        try:
+            page = int(query.get("page", ["1"])[0])
+        except ValueError:
+            page = 1
+        page = min(max(page, 1), pages)
+        if pages > 1:
+            lines = lines[(page - 1) * page_size:page * page_size]
+            nav = "<p>Page %d of %d" % (page, pages)
+            if page > 1:
+                nav += ' <a href="?page=%d%s">previous</a>' % (page - 1, view)
+            if page < pages:
+                nav += ' <a href="?page=%d%s">next</a>' % (page + 1, view)
+            nav = (nav + "</p>\n").encode()
+        else:
+            nav = b""
+        displaypath = html.escape(urllib.parse.unquote(url.path))
+        head = BytesIO()
+        head.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
+        head.write(("<html>\n<title>Directory listing for %s</title>\n" % displaypath).encode())
+        head.write(("<body>\n<h2>Directory listing for %s</h2>\n" % displaypath).encode())
+        head.write(b"<hr>\n")
+        head.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\">")
+        head.write(b"<input name=\"file\" type=\"file\" multiple/>")
+        head.write(b"<input type=\"submit\" value=\"upload\"/></form>\n")
+        head.write(b"<a href=\"?upload\">Resumable upload of many files</a>\n")
+        if gallery:
+            head.write(b"| <a href=\"?\">List</a>\n")
+        elif self.thumbnailer is not None:
+            head.write(b"| <a href=\"?view=thumbnails\">Thumbnails</a>\n")
+        head.write(b"<hr>\n")
+        head.write(nav)
+        head.write(b"<div>\n" if gallery else b"<ul>\n")
+        tail = ((b"</div>\n" if gallery else b"</ul>\n") + nav +
+                b"<hr>\n</body>\n</html>\n")
+        chunks = [head.getvalue()] + lines + [tail]
+        self.send_response(200)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(sum(map(len, chunks))))
+        self.end_headers()
+        return ChunkReader(chunks)
+
+    def listing_format(self, query):
+        """Choose between the html, json and ndjson directory listings."""
+        fmt = query.get("format", [""])[0].lower()
+        if fmt in ("html", "json", "ndjson"):
+            return fmt
+        accept = self.headers.get("Accept", "")
+        if "application/x-ndjson" in accept:
+            return "ndjson"
+        if "application/json" in accept:
+            return "json"
+        return "html"
+
+    def list_directory_json(self, path, query, ndjson):
+        """Produce a machine-readable directory listing.
+
+        Each entry has its name, type ("file", "dir" or "other", after
+        following symlinks), whether it is a symlink, size and mtime.
+        A "since" query parameter (a Unix timestamp) restricts the
+        listing to entries modified after that moment.
+
+        As JSON, the entries are sorted by name and sent as a single
+        object.  As NDJSON, one entry per line is streamed while the
+        directory is being read, in directory order.
+
+        """
+        try:
+            since = float(query["since"][0]) if "since" in query else None
+        except ValueError:
+            self.send_error(400, "Invalid since parameter")
+            return None
+        try:
+            it = os.scandir(path)
+        except OSError:
+            self.send_error(404, "No permission to list directory")
+            return None
+        entries = scan_directory(it, since)
+        if ndjson:
+            self.send_response(200)
+            self.send_header("Content-type", "application/x-ndjson")
+            self.send_chunked_header()
+            self.end_headers()
+            return ChunkReader((json.dumps(entry) + "\n").encode()
+                               for entry in entries)
+        body = json.dumps({
+            "path": urllib.parse.unquote(urllib.parse.urlsplit(self.path).path),
+            "entries": sorted(entries, key=lambda e: e["name"].lower()),
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return BytesIO(body)
+
+    def directory_lines(self, path):
+        """Return the rendered <li> lines for the entries of PATH.
+
+        The lines are sorted by name and cached in listing_cache until
+        the modification time of the directory changes.  Raises OSError
+        if the directory cannot be read.
+
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cache = self.listing_cache
+        cached = cache.get(path) if cache is not None else None
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name.lower())
+        lines = []
+        for entry in entries:
+            name = entry.name
             displayname = linkname = name
             # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
+            if entry.is_dir():
                 displayname = name + "/"
                 linkname = name + "/"
-            if os.path.islink(fullname):
+            if entry.is_symlink():
                 displayname = name + "@"
                 # Note: a link to a directory displays with @ and links with /
-            f.write(('<li><a href="%s">%s</a>\n'
-                    % (urllib.parse.quote(linkname), cgi.escape(displayname))).encode())
-        f.write(b"</ul>\n<hr>\n</body>\n</html>\n")
-        length = f.tell()
-        f.seek(0)
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.send_header("Content-Length", str(length))
-        self.end_headers()
-        return f
+            lines.append(('<li><a href="%s">%s</a>\n'
+                          % (urllib.parse.quote(linkname),
+                             html.escape(displayname, quote=False))).encode())
+        if cache is not None:
+            cache.put(path, (mtime, lines))
+        return lines
+
+    def resolve_path(self, path):
+        """Translate PATH and find out what it refers to.
+
+        Return value is a (path, isdir, target, ctype) tuple, where
+        TARGET is the file to serve (the index page of a directory),
+        or None if a directory listing is needed, and CTYPE is the
+        MIME type of TARGET.
+
+        Results are kept in path_cache, if there is one, for as long
+        as the modification time of the translated path is unchanged;
+        on a hit, a single stat() replaces the translation, the index
+        page lookup and the MIME type guess.
+
+        """
+        key = path.split('?', 1)[0].split('#', 1)[0]
+        cache = self.path_cache
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                try:
+                    st = os.stat(cached[0])
+                    version = (st.st_mtime_ns, stat.S_ISDIR(st.st_mode))
+                except OSError:
+                    version = None
+                if version == cached[4]:
+                    return cached[:4]
+                cache.pop(key)
+        path = self.translate_path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, False, path, self.guess_type(path)
+        isdir = stat.S_ISDIR(st.st_mode)
+        target = path
+        if isdir:
+            for index in "index.html", "index.htm":
+                index = os.path.join(path, index)
+                if os.path.exists(index):
+                    target = index
+                    break
+            else:
+                target = None
+        ctype = self.guess_type(target) if target is not None else None
+        if cache is not None:
+            cache.put(key, (path, isdir, target, ctype,
+                            (st.st_mtime_ns, isdir)))
+        return path, isdir, target, ctype
+
+    def gallery_lines(self, path):
+        """Return the rendered tiles of the thumbnail view of PATH.
+
+        Like directory_lines(), but images are shown by their preview.
+        The previews are loaded lazily by the browser, so only those in
+        view are requested, and made by the thumbnailer's workers.
+
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cache = self.listing_cache
+        key = path + "\0thumbnails"
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name.lower())
+        size = self.thumbnailer.size
+        style = ("display:inline-block;width:%dpx;height:%dpx;margin:2px;"
+                 "text-align:center;vertical-align:top;overflow:hidden"
+                 % (size, size + 20))
+        lines = []
+        for entry in entries:
+            name = entry.name
+            is_dir = entry.is_dir()
+            linkname = urllib.parse.quote(name + "/" if is_dir else name)
+            displayname = html.escape(name + "/" if is_dir else name)
+            if not is_dir and self.guess_type(name).startswith("image/"):
+                content = ('<img src="%s?thumbnail" loading="lazy" alt=""'
+                           ' style="max-width:%dpx;max-height:%dpx"><br>'
+                           % (linkname, size, size))
+            else:
+                content = ""
+            lines.append(('<a href="%s" title="%s" style="%s">%s%s</a>\n'
+                          % (linkname, displayname, style, content,
+                             displayname)).encode())
+        if cache is not None:
+            cache.put(key, (mtime, lines))
+        return lines
 
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax.
@@ -242,7 +1476,7 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             path = os.path.join(path, word)
         return path
 
-    def copyfile(self, source, outputfile):
+    def copyfile(self, source, outputfile, length=None):
         """Copy all data between two file objects.
 
         The SOURCE argument is a file object open for reading
@@ -255,8 +1489,72 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         -- note however that this the default server uses this
         to copy binary data as well.
 
+        If LENGTH is given, only that many bytes are copied, starting
+        at the current position of SOURCE.  If SOURCE ends before that,
+        the connection is closed after the response, as its framing
+        can no longer be trusted.
+
+        SOURCE may also be a DeferredBody, which writes itself.
+
+        When copying a regular file to the client connection, the data
+        is handed to the kernel with sendfile(), so it never passes
+        through Python buffers.  Anything else falls back to a plain
+        userspace copy.
+
+        Either way, the copy is slowed down to the rates allowed by
+        download_limiter, if there is one.
+
         """
-        shutil.copyfileobj(source, outputfile)
+        limiter = self.download_limiter
+        if self.use_sendfile and outputfile is self.wfile:
+            try:
+                fd = source.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                fd = None
+            if fd is not None and stat.S_ISREG(os.fstat(fd).st_mode):
+                outputfile.flush()
+                # socket.sendfile() itself falls back to send() on
+                # platforms (or sockets) where os.sendfile() is unusable.
+                if limiter is None:
+                    sent = self.connection.sendfile(source, source.tell(),
+                                                    length)
+                    if self.counting:
+                        self.count_sent(sent)
+                    if length is not None and sent < length:
+                        self.close_connection = True
+                    return
+                # Send in slices, waiting for the rate limit before each.
+                offset = source.tell()
+                if length is None:
+                    length = os.fstat(fd).st_size - offset
+                while length > 0:
+                    count = min(length, limiter.chunk_size)
+                    limiter.throttle(self.client_address[0], count)
+                    sent = self.connection.sendfile(source, offset, count)
+                    if self.counting:
+                        self.count_sent(sent)
+                    if not sent:
+                        self.close_connection = True
+                        break
+                    offset += sent
+                    length -= sent
+                return
+        if limiter is not None:
+            outputfile = ThrottledWriter(outputfile, limiter,
+                                         self.client_address[0])
+        if isinstance(source, DeferredBody):
+            source.writeto(outputfile)
+            return
+        if length is None:
+            shutil.copyfileobj(source, outputfile)
+            return
+        while length > 0:
+            buf = source.read(min(length, 64 * 1024))
+            if not buf:
+                self.close_connection = True
+                break
+            outputfile.write(buf)
+            length -= len(buf)
 
     def guess_type(self, path):
         """Guess the type of a file.
@@ -293,9 +1591,2569 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         })
 
 
-def test(HandlerClass=SimpleHTTPRequestHandler,
-         ServerClass=http.server.HTTPServer):
-    http.server.test(HandlerClass, ServerClass)
+class LimitedReader:
+
+    """File-like wrapper that reads at most LENGTH bytes from FP.
+
+    Like read1(), read() returns whatever is available (up to SIZE
+    bytes) instead of waiting for SIZE bytes.
+
+    """
+
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.read1 = getattr(fp, "read1", fp.read)
+        self.remaining = length
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        if size <= 0:
+            return b""
+        data = self.read1(size)
+        self.remaining -= len(data)
+        return data
+
+    def length_hint(self):
+        return self.remaining
+
+
+# Names used in Digest headers (RFC 3230) for some hashlib algorithms.
+DIGEST_NAMES = {
+    "md5": "md5",
+    "sha": "sha1",
+    "sha-256": "sha256",
+    "sha-512": "sha512",
+}
+
+
+def new_hash(name):
+    """Create a hash object for a hashlib or xxhash algorithm name."""
+    if name.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError("The xxhash module is not installed")
+        try:
+            return getattr(xxhash, name)()
+        except AttributeError:
+            raise ValueError("Unknown xxhash algorithm: %s" % name)
+    h = hashlib.new(name)
+    if not h.digest_size:
+        # SHAKE: digest() needs a length, which Digest headers lack.
+        raise ValueError("Variable-length digest algorithm: %s" % name)
+    return h
+
+
+def parse_digest_header(header):
+    """Parse a Digest header into a dict of hashlib names to digests.
+
+    Algorithms that hashlib doesn't know, or whose digests have no
+    fixed length (SHAKE), are ignored.
+
+    >>> digests = parse_digest_header(
+    ...     "SHA-256=47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=, foo=bar,"
+    ...     " shake_128=AAAA")
+    >>> {name: value.hex()[:16] for name, value in digests.items()}
+    {'sha256': 'e3b0c44298fc1c14'}
+
+    """
+    digests = {}
+    for item in header.split(","):
+        algorithm, sep, value = item.strip().partition("=")
+        algorithm = algorithm.lower()
+        name = DIGEST_NAMES.get(algorithm, algorithm)
+        if (not sep or name not in hashlib.algorithms_available
+                or name.startswith("shake_")):
+            continue
+        try:
+            digests[name] = base64.b64decode(value.strip(), validate=True)
+        except ValueError:
+            raise ValueError("Invalid Digest header")
+    return digests
+
+
+def format_digest_header(digests):
+    """Format a dict of algorithm names to digests as a Digest header."""
+    names = {name: algorithm for algorithm, name in DIGEST_NAMES.items()}
+    return ", ".join("%s=%s" % (names.get(name, name),
+                                base64.b64encode(value).decode())
+                     for name, value in sorted(digests.items()))
+
+
+class AtomicFile:
+
+    """Binary file that only appears as FILENAME once complete.
+
+    Data is written to a temporary file in the same directory, which
+    is renamed to FILENAME by commit().  If the file is closed (or the
+    with block is left) without calling commit(), the temporary file
+    is removed.
+
+    If SIZE is given, that much disk space is allocated upfront, which
+    avoids fragmentation and fails early if the disk is full; the file
+    is truncated to the size actually written on commit().
+
+    FSYNC is the durability policy: "none" leaves flushing to the OS,
+    "file" syncs the data before the rename, and "full" also syncs
+    the directory after it, so that the rename itself is durable.
+
+    The hashes attribute maps each name in ALGORITHMS to a hash
+    object, updated with the data as it is written.
+
+    """
+
+    def __init__(self, filename, size=None, fsync="none", algorithms=()):
+        self.filename = filename
+        self.fsync = fsync
+        self.hashes = {name: new_hash(name) for name in algorithms}
+        self.written = 0
+        self.preallocated = False
+        directory, name = os.path.split(filename)
+        self.tmpname = os.path.join(
+            directory, ".%s.%s.part" % (name, os.urandom(4).hex()))
+        # Unlike tempfile.mkstemp(), this honours the umask.
+        fd = os.open(self.tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     0o666)
+        self.file = os.fdopen(fd, 'wb')
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                self.preallocated = True
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS,
+                                   errno.EINVAL):
+                    self.close()
+                    raise
+
+    def write(self, data):
+        self.written += len(data)
+        for h in self.hashes.values():
+            h.update(data)
+        return self.file.write(data)
+
+    def commit(self):
+        self.file.flush()
+        if self.preallocated:
+            os.ftruncate(self.file.fileno(), self.written)
+        if self.fsync in ("file", "full"):
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmpname, self.filename)
+        self.tmpname = None
+        if self.fsync == "full":
+            fd = os.open(os.path.dirname(self.filename) or os.curdir,
+                         os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.file.close()
+        if self.tmpname is not None:
+            try:
+                os.remove(self.tmpname)
+            except OSError:
+                pass
+            self.tmpname = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Page served for a directory with an "upload" query parameter.  Files
+# are sent as PART_SIZE parts with Content-Range PUT requests, named by
+# the size and modification time of the file in X-Upload-Id, PARALLEL
+# at a time; parts that fail for a transient reason are retried, up to
+# MAX_TRIES times, and an interrupted upload of the same file resumes
+# from the ranges the server already received.
+UPLOAD_PAGE = """\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Upload to %(path)s</title>
+</head>
+<body>
+<h2>Upload to %(path)s</h2>
+<hr>
+<p><input id="files" type="file" multiple> <a href="./">back</a></p>
+<table id="progress"></table>
+<hr>
+<script>
+var PART_SIZE = 8 * 1024 * 1024;
+var PARALLEL = 4;
+var MAX_TRIES = 8;
+var queue = [];
+var active = 0;
+
+function status(row, text) {
+    row.cells[1].textContent = text;
+}
+
+function addRow(file) {
+    var row = document.getElementById("progress").insertRow();
+    row.insertCell().textContent = file.name;
+    row.insertCell();
+    return row;
+}
+
+function startFile(file) {
+    var url = encodeURIComponent(file.name);
+    var row = addRow(file);
+    var job = {file: file, url: url, row: row, pending: 0, done: 0,
+               id: file.size + "-" + file.lastModified};
+    if (file.size == 0) {
+        queue.push({job: job, first: 0, last: -1, tries: 0});
+        pump();
+        return;
+    }
+    status(row, "checking...");
+    fetch(url + "?upload", {cache: "no-store"}).then(function(response) {
+        return response.ok ? response.json() : {size: file.size, received: []};
+    }).catch(function() {
+        return {size: file.size, received: []};
+    }).then(function(progress) {
+        // Only resume an upload of this very file.
+        var received = progress.size == file.size && progress.id == job.id ?
+            progress.received : [];
+        for (var first = 0; first < file.size; first += PART_SIZE) {
+            var last = Math.min(first + PART_SIZE, file.size) - 1;
+            var have = received.some(function(r) {
+                return r[0] <= first && last <= r[1];
+            });
+            if (have) {
+                job.done += last - first + 1;
+            } else {
+                job.pending++;
+                queue.push({job: job, first: first, last: last, tries: 0});
+            }
+        }
+        if (job.pending == 0) {
+            // Everything was received; send the last part again to finish.
+            var first = Math.floor((file.size - 1) / PART_SIZE) * PART_SIZE;
+            job.pending++;
+            job.done -= file.size - first;
+            queue.push({job: job, first: first, last: file.size - 1, tries: 0});
+        }
+        showProgress(job);
+        pump();
+    });
+}
+
+function showProgress(job) {
+    var size = job.file.size;
+    status(job.row, size ? Math.floor(100 * job.done / size) + "%%" : "...");
+}
+
+function pump() {
+    while (active < PARALLEL && queue.length) {
+        active++;
+        sendPart(queue.shift());
+    }
+}
+
+function sendPart(part) {
+    var job = part.job;
+    var headers = {};
+    if (part.last >= part.first) {
+        headers["Content-Range"] = "bytes " + part.first + "-" + part.last +
+            "/" + job.file.size;
+        headers["X-Upload-Id"] = job.id;
+    }
+    fetch(job.url, {
+        method: "PUT",
+        headers: headers,
+        body: job.file.slice(part.first, part.last + 1)
+    }).then(function(response) {
+        // Not implemented or out of space: retrying won't help.
+        if (response.status >= 500 && response.status != 501 &&
+                response.status != 507) {
+            throw new Error(response.statusText);
+        }
+        active--;
+        if (!response.ok) {
+            job.failed = true;
+            status(job.row, "failed: " + response.status + " " +
+                   response.statusText);
+        } else if (!job.failed) {
+            job.pending--;
+            job.done += part.last - part.first + 1;
+            if (response.status == 202) {
+                showProgress(job);
+            } else {
+                status(job.row, "done");
+            }
+        }
+        pump();
+    }).catch(function(error) {
+        // Network error or server failure: retry with a growing delay.
+        part.tries++;
+        if (part.tries >= MAX_TRIES) {
+            active--;
+            job.failed = true;
+            status(job.row, "failed: " + error.message);
+            pump();
+            return;
+        }
+        status(job.row, "retrying (" + error.message + ")...");
+        setTimeout(function() {
+            active--;
+            queue.unshift(part);
+            pump();
+        }, Math.min(1000 * Math.pow(2, part.tries), 30000));
+    });
+}
+
+document.getElementById("files").onchange = function() {
+    for (var i = 0; i < this.files.length; i++) {
+        startFile(this.files[i]);
+    }
+    this.value = "";
+};
+</script>
+</body>
+</html>
+"""
+
+
+class ResumableUpload:
+
+    """A file uploaded in parts, which may arrive in any order.
+
+    Parts are written in place into a hidden ".NAME.upload" file in
+    the directory of FILENAME, sized to the whole file upfront, and
+    each completed part is then appended to the ".NAME.upload.idx"
+    part index.  Once the index covers the whole file, it is renamed
+    to FILENAME, so finishing never copies or reads back any data.
+
+    A part whose request was interrupted never reaches the index; the
+    client asks which ranges were received and sends the rest again.
+    Such a part may also arrive again after the upload finished, if
+    only its response was lost: it is then checked against FILENAME
+    instead of starting a new upload.
+
+    The client names each upload with UPLOAD_ID (the upload page uses
+    the size and modification time of the file), which is kept at the
+    start of the index.  A part of another upload of the same name (a
+    different id or size), or one arriving after the partial file was
+    left untouched for max_age seconds, discards the partial file and
+    starts over; so does cancel().  Expired partial files of other
+    uploads in the same directory are removed when an upload starts.
+
+    """
+
+    # Serializes the part index updates of all uploads.
+    lock = threading.Lock()
+
+    # Partial files untouched for longer than this are discarded.
+    max_age = 24 * 3600
+
+    # Uploads finished within the last finished_window seconds, as
+    # filename -> (size, st_mtime_ns, time.monotonic()).
+    finished = {}
+    finished_window = 60
+
+    def __init__(self, filename, upload_id=""):
+        directory, name = os.path.split(filename)
+        self.filename = filename
+        self.upload_id = upload_id
+        self.partname = os.path.join(directory, ".%s.upload" % name)
+        self.indexname = self.partname + ".idx"
+        self.inode = None
+
+    def size(self):
+        """Return the size of the whole file, or None if not started."""
+        try:
+            return os.stat(self.partname).st_size
+        except FileNotFoundError:
+            return None
+
+    def received(self):
+        """Return the merged (first, last) ranges received so far."""
+        ranges = []
+        try:
+            with open(self.indexname) as f:
+                for line in f:
+                    fields = line.split()
+                    # Skip the id, and a line torn by a crash while
+                    # appending.
+                    if len(fields) == 2 and all(map(str.isdigit, fields)):
+                        ranges.append((int(fields[0]), int(fields[1])))
+        except FileNotFoundError:
+            pass
+        return merge_ranges(ranges)
+
+    def stored_id(self):
+        """Return the id of the upload in progress, "" if it has none."""
+        try:
+            with open(self.indexname) as f:
+                line = f.readline()
+        except FileNotFoundError:
+            return ""
+        key, sep, value = line.rstrip("\n").partition(" ")
+        return value if key == "id" else ""
+
+    def cancel(self):
+        """Discard the upload in progress; return False if there is none."""
+        with self.lock:
+            return self.discard()
+
+    def discard(self):
+        # Call with the lock held.
+        try:
+            os.remove(self.partname)
+        except FileNotFoundError:
+            found = False
+        else:
+            found = True
+        try:
+            os.remove(self.indexname)
+        except FileNotFoundError:
+            pass
+        return found
+
+    def remove_expired(self):
+        """Discard the uploads in the directory of FILENAME that have
+        been left untouched for more than max_age seconds."""
+        # Call with the lock held.
+        directory = os.path.dirname(self.filename) or os.curdir
+        deadline = time.time() - self.max_age
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not (entry.name.startswith(".")
+                        and entry.name.endswith(".upload")):
+                    continue
+                try:
+                    if entry.stat().st_mtime < deadline:
+                        os.remove(entry.path)
+                        os.remove(entry.path + ".idx")
+                except OSError:
+                    pass
+
+    def write_part(self, first, total, body, bufsize, fsync="none"):
+        """Write the data read from BODY at offset FIRST.
+
+        TOTAL is the size of the whole file.  If it differs from the
+        size of the upload in progress, that upload is discarded, as it
+        is if its id differs or it expired.  Return value is the number
+        of bytes written, or None if the upload just finished, and the
+        part matches FILENAME; ValueError is raised if it doesn't.
+
+        """
+        with self.lock:
+            try:
+                st = os.stat(self.partname)
+            except FileNotFoundError:
+                st = None
+            if st is None and self.just_finished(total):
+                fd = None
+            elif (st is not None and st.st_size == total
+                    and st.st_mtime > time.time() - self.max_age
+                    and self.stored_id() == self.upload_id):
+                fd = os.open(self.partname, os.O_WRONLY)
+            else:
+                self.discard()
+                self.remove_expired()
+                with open(self.indexname, "w") as f:
+                    f.write("id %s\n" % self.upload_id)
+                fd = os.open(self.partname, os.O_WRONLY | os.O_CREAT, 0o666)
+                try:
+                    os.ftruncate(fd, total)
+                except OSError:
+                    os.close(fd)
+                    raise
+            if fd is not None:
+                self.inode = os.fstat(fd).st_ino
+        if fd is None:
+            self.check_part(first, body, bufsize)
+            return None
+        try:
+            offset = first
+            for data in iter(lambda: body.read(bufsize), b""):
+                view = memoryview(data)
+                while view:
+                    n = os.pwrite(fd, view, offset)
+                    offset += n
+                    view = view[n:]
+            if fsync in ("file", "full"):
+                os.fsync(fd)
+            return offset - first
+        finally:
+            os.close(fd)
+
+    def just_finished(self, total):
+        """Tell whether FILENAME is a TOTAL bytes upload finished
+        recently, and unchanged since."""
+        record = self.finished.get(self.filename)
+        if (record is None
+                or time.monotonic() - record[2] > self.finished_window):
+            return False
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return (st.st_size == total
+                and (st.st_size, st.st_mtime_ns) == record[:2])
+
+    def check_part(self, first, body, bufsize):
+        """Check that the data read from BODY is in FILENAME at offset
+        FIRST, raising ValueError if not."""
+        with open(self.filename, "rb") as f:
+            f.seek(first)
+            for data in iter(lambda: body.read(bufsize), b""):
+                if f.read(len(data)) != data:
+                    raise ValueError("An upload of this file just finished")
+
+    def add_part(self, first, last, fsync="none"):
+        """Record a written part in the index, finishing if complete.
+
+        Return value is True if that was the last missing part, and
+        FILENAME now holds the whole file.
+
+        """
+        with self.lock:
+            try:
+                inode = os.stat(self.partname).st_ino
+            except FileNotFoundError:
+                inode = None
+            if inode != self.inode:
+                if inode is None and self.filename in self.finished:
+                    try:
+                        if os.stat(self.filename).st_ino == self.inode:
+                            # Another part finished the upload meanwhile.
+                            return True
+                    except OSError:
+                        pass
+                raise ValueError("The upload was cancelled or restarted")
+            with open(self.indexname, "a") as f:
+                f.write("%d %d\n" % (first, last))
+                if fsync in ("file", "full"):
+                    f.flush()
+                    os.fsync(f.fileno())
+            total = os.stat(self.partname).st_size
+            if self.received() != [(0, total - 1)]:
+                return False
+            os.replace(self.partname, self.filename)
+            os.remove(self.indexname)
+            now = time.monotonic()
+            for name, record in list(self.finished.items()):
+                if now - record[2] > self.finished_window:
+                    del self.finished[name]
+            st = os.stat(self.filename)
+            self.finished[self.filename] = (st.st_size, st.st_mtime_ns, now)
+        if fsync == "full":
+            fd = os.open(os.path.dirname(self.filename) or os.curdir,
+                         os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return True
+
+
+class ChunkedReader:
+
+    """File-like object that decodes a chunked request body from FP.
+
+    read() returns at most SIZE bytes of the current chunk, as soon as
+    they are available, and b"" after the last chunk.  A malformed or
+    truncated body raises ValueError.
+
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.read1 = getattr(fp, "read1", fp.read)
+        self.remaining = 0  # Bytes left in the current chunk.
+        self.finished = False
+
+    def read(self, size):
+        if self.finished or size <= 0:
+            return b""
+        if self.remaining == 0:
+            line = self.fp.readline(1024)
+            if not line.endswith(b"\n"):
+                raise ValueError("Unexpect Ends of data.")
+            try:
+                # Ignore chunk extensions.
+                self.remaining = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                self.remaining = -1
+            if self.remaining < 0:
+                raise ValueError("Invalid chunk size.")
+            if self.remaining == 0:
+                # Skip the trailer fields, up to the final empty line.
+                while line not in (b"\r\n", b"\n", b""):
+                    line = self.fp.readline(64 * 1024)
+                self.finished = True
+                return b""
+        data = self.read1(min(size, self.remaining))
+        if not data:
+            raise ValueError("Unexpect Ends of data.")
+        self.remaining -= len(data)
+        if self.remaining == 0 and self.fp.readline(1024).strip():
+            raise ValueError("Missing line break after chunk.")
+        return data
+
+
+class MultipartReader:
+
+    """Streaming parser for multipart/form-data bodies.
+
+    The body is read from FP in chunks of BUFSIZE bytes and the
+    boundary is searched for inside the buffered data, so the cost
+    does not depend on how many newlines the uploaded files contain,
+    and memory use does not depend on their size.
+
+    Call next_part() to get the headers of each part (as a dict with
+    lowercase keys), then optionally read_part() to receive its
+    contents.  next_part() returns None after the last part.
+    Malformed or truncated bodies raise ValueError.
+
+    """
+
+    max_header_size = 64 * 1024
+
+    def __init__(self, fp, boundary, bufsize=256 * 1024):
+        self.fp = fp
+        self.delimiter = b"\r\n--" + boundary
+        self.bufsize = bufsize
+        # Pretend the body starts with a line break, so that the first
+        # boundary looks the same as the following ones.
+        self.buf = bytearray(b"\r\n")
+        self.in_part = True  # The preamble is skipped like a part.
+        self.finished = False
+
+    def _fill(self):
+        data = self.fp.read(self.bufsize)
+        if not data:
+            raise ValueError("Unexpect Ends of data.")
+        self.buf += data
+
+    def read_part(self, write):
+        """Pass the rest of the current part to WRITE, chunk by chunk."""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buf.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    write(bytes(self.buf[:index]))
+                del self.buf[:index + len(self.delimiter)]
+                self.in_part = False
+                return
+            if len(self.buf) > keep:
+                write(bytes(self.buf[:-keep]))
+                del self.buf[:-keep]
+            self._fill()
+
+    def next_part(self):
+        """Skip to the next part and return its headers."""
+        if self.finished:
+            return None
+        if self.in_part:
+            # Skip the preamble, or whatever is left of the previous part.
+            self.read_part(lambda data: None)
+        while len(self.buf) < 2:
+            self._fill()
+        if self.buf.startswith(b"--"):
+            self.finished = True
+            return None
+        while True:
+            end = self.buf.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(self.buf) > self.max_header_size:
+                raise ValueError("Part headers are too long.")
+            self._fill()
+        lines = self.buf[:end].decode("utf-8", "replace").split("\r\n")
+        del self.buf[:end + 4]
+        headers = {}
+        # The first line is the (possibly padded) end of the boundary line.
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        self.in_part = True
+        return headers
+
+
+class LRUCache:
+
+    """Thread-safe mapping that keeps the MAXSIZE most recently used items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def setdefault(self, key, value):
+        with self.lock:
+            value = self.items.setdefault(key, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+            return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+
+class ContentCache:
+
+    """Thread-safe cache of small file contents, within MAX_BYTES.
+
+    The least recently used files are evicted first.  An entry is
+    dropped when the size, modification time or inode of its file
+    changes.
+
+    """
+
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, filename):
+        """Return a (stat, data) tuple for FILENAME, or None."""
+        with self.lock:
+            entry = self.items.get(filename)
+        if entry is None:
+            return None
+        fs, data = entry
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        if st is None or ((st.st_mtime_ns, st.st_size, st.st_ino) !=
+                          (fs.st_mtime_ns, fs.st_size, fs.st_ino)):
+            with self.lock:
+                if self.items.get(filename) is entry:
+                    del self.items[filename]
+                    self.size -= len(data)
+            return None
+        with self.lock:
+            if filename in self.items:
+                self.items.move_to_end(filename)
+        return entry
+
+    def load(self, filename, f, fs):
+        """Read the file F, opened from FILENAME, into the cache.
+
+        FS is the stat of F.  Return value is the data read, or None
+        (with F left at its start) if F is not a small regular file.
+
+        """
+        if not stat.S_ISREG(fs.st_mode) or fs.st_size > self.max_file_size:
+            return None
+        data = f.read(fs.st_size + 1)
+        if len(data) != fs.st_size:
+            # Modified while being read; serve it from the file.
+            f.seek(0)
+            return None
+        with self.lock:
+            old = self.items.pop(filename, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.items[filename] = (fs, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                evicted = self.items.popitem(last=False)[1][1]
+                self.size -= len(evicted)
+        return data
+
+
+class TokenBucket:
+
+    """Token bucket refilled with RATE tokens per second.
+
+    At most BURST tokens (by default, one second worth of them) can be
+    saved up.  Tokens can be borrowed: consume() always succeeds, and
+    returns how long the caller should wait before using them, so
+    concurrent users queue up fairly without polling.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+
+    """Bandwidth limit for one direction of traffic, in bytes per second.
+
+    RATE applies to all clients together, and PER_CLIENT_RATE to each
+    client address on its own; either may be 0 for no limit.
+
+    """
+
+    def __init__(self, rate=0, per_client_rate=0):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.per_client_rate = per_client_rate
+        self.clients = LRUCache(4096) if per_client_rate else None
+        # Throttle in slices small enough to spread over a second.
+        slowest = min(r for r in (rate, per_client_rate) if r)
+        self.chunk_size = max(4096, min(256 * 1024, slowest // 8))
+
+    def throttle(self, client, nbytes):
+        """Sleep until CLIENT may transfer NBYTES more bytes."""
+        wait = self.delay(client, nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+    def delay(self, client, nbytes):
+        """Reserve NBYTES for CLIENT, and return how long to wait before
+        transferring them."""
+        wait = 0.0
+        if self.bucket is not None:
+            wait = self.bucket.consume(nbytes)
+        if self.clients is not None:
+            bucket = self.clients.get(client)
+            if bucket is None:
+                bucket = self.clients.setdefault(
+                    client, TokenBucket(self.per_client_rate))
+            wait = max(wait, bucket.consume(nbytes))
+        return wait
+
+
+class ThrottledReader:
+
+    """Request body reader slowed down by a RateLimiter."""
+
+    def __init__(self, fp, limiter, client):
+        self.fp = fp
+        self.limiter = limiter
+        self.client = client
+
+    def read(self, size):
+        data = self.fp.read(min(size, self.limiter.chunk_size))
+        self.limiter.throttle(self.client, len(data))
+        return data
+
+    def length_hint(self):
+        return self.fp.length_hint()
+
+
+class ThrottledWriter:
+
+    """Writer slowed down by a RateLimiter."""
+
+    closed = False
+
+    def __init__(self, fp, limiter, client):
+        self.fp = fp
+        self.limiter = limiter
+        self.client = client
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), self.limiter.chunk_size):
+            chunk = view[start:start + self.limiter.chunk_size]
+            self.limiter.throttle(self.client, len(chunk))
+            self.fp.write(chunk)
+        return len(view)
+
+    def flush(self):
+        self.fp.flush()
+
+
+class CountingReader:
+
+    """Reader that reports how many bytes are read to COUNT(nbytes)."""
+
+    def __init__(self, fp, count):
+        self.fp = fp
+        self.count = count
+
+    def read(self, size):
+        data = self.fp.read(size)
+        self.count(len(data))
+        return data
+
+    def length_hint(self):
+        return self.fp.length_hint()
+
+
+class CountingWriter:
+
+    """Writer that reports how many bytes are written to COUNT(nbytes)."""
+
+    def __init__(self, fp, count):
+        self.fp = fp
+        self.count = count
+
+    def write(self, data):
+        n = self.fp.write(data)
+        self.count(len(data))
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class AccessLog:
+
+    """Access log written as JSON lines to STREAM by a background thread.
+
+    Request threads only put records in a queue of at most MAXSIZE
+    entries; the writer thread takes up to BATCH_SIZE of them at a
+    time, and writes them with a single write() and flush().  When the
+    queue is full, records are dropped instead of slowing requests
+    down: the dropped attribute counts them, and a record with their
+    count is written once there is room again.
+
+    """
+
+    def __init__(self, stream, maxsize=10000, batch_size=256):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.reported = 0
+        self.thread = threading.Thread(target=self.run, name="access-log",
+                                       daemon=True)
+        self.thread.start()
+
+    def log(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            with self.lock:
+                dropped = self.dropped - self.reported
+                self.reported = self.dropped
+            if dropped:
+                records.append({"time": round(time.time(), 3),
+                                "dropped": dropped})
+            try:
+                self.stream.write("".join(json.dumps(record) + "\n"
+                                          for record in records))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+            self.written += len(records)
+            if None in batch:
+                return
+
+    def close(self):
+        """Write the queued records and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Metrics:
+
+    """Server metrics, rendered in the Prometheus text format."""
+
+    prefix = "simplehttp_"
+    methods = ("GET", "HEAD", "POST", "PUT")
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+               30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (method, code) -> count
+        self.durations = {}  # method -> [bucket counts..., sum, count]
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.active_connections = 0
+        self.upload_bytes = 0
+        self.upload_seconds = 0.0
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+    def count_sent(self, nbytes):
+        with self.lock:
+            self.sent_bytes += nbytes
+
+    def count_received(self, nbytes):
+        with self.lock:
+            self.received_bytes += nbytes
+
+    def observe_request(self, method, code, duration, received):
+        if method not in self.methods:
+            method = "other"
+        with self.lock:
+            key = (method, code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            hist = self.durations.get(method)
+            if hist is None:
+                hist = self.durations[method] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    hist[i] += 1
+            hist[-2] += duration
+            hist[-1] += 1
+            if method in ("POST", "PUT") and received:
+                self.upload_bytes += received
+                self.upload_seconds += duration
+
+    def render(self):
+        p = self.prefix
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append("# HELP %s%s %s" % (p, name, help))
+            lines.append("# TYPE %s%s %s" % (p, name, kind))
+
+        with self.lock:
+            metric("requests_total", "counter", "Requests handled.")
+            for (method, code), count in sorted(self.requests.items()):
+                lines.append('%srequests_total{method="%s",code="%s"} %d'
+                             % (p, method, code, count))
+            metric("request_duration_seconds", "histogram",
+                   "Time spent handling requests.")
+            for method, hist in sorted(self.durations.items()):
+                for bound, count in zip(self.buckets, hist):
+                    lines.append('%srequest_duration_seconds_bucket{method="%s",le="%g"} %d'
+                                 % (p, method, bound, count))
+                lines.append('%srequest_duration_seconds_bucket{method="%s",le="+Inf"} %d'
+                             % (p, method, hist[-1]))
+                lines.append('%srequest_duration_seconds_sum{method="%s"} %f'
+                             % (p, method, hist[-2]))
+                lines.append('%srequest_duration_seconds_count{method="%s"} %d'
+                             % (p, method, hist[-1]))
+            metric("sent_bytes_total", "counter", "Bytes sent to clients.")
+            lines.append("%ssent_bytes_total %d" % (p, self.sent_bytes))
+            metric("received_bytes_total", "counter",
+                   "Request body bytes received from clients.")
+            lines.append("%sreceived_bytes_total %d" % (p, self.received_bytes))
+            metric("active_connections", "gauge",
+                   "Connections being handled (idle keep-alive connections"
+                   " of the asyncio engine are not included).")
+            lines.append("%sactive_connections %d" % (p, self.active_connections))
+            metric("upload_bytes_total", "counter",
+                   "Bytes received in POST and PUT bodies.")
+            lines.append("%supload_bytes_total %d" % (p, self.upload_bytes))
+            metric("upload_seconds_total", "counter",
+                   "Time spent handling POST and PUT requests with a body;"
+                   " upload throughput is upload_bytes_total divided by this.")
+            lines.append("%supload_seconds_total %f" % (p, self.upload_seconds))
+        return "\n".join(lines) + "\n"
+
+
+class RequestProfiler:
+
+    """Profile one request out of every EVERY with cProfile.
+
+    Only one request is profiled at a time (Python 3.12 and later
+    refuse to run two profilers at once): requests due for profiling
+    while another one is run unprofiled.
+
+    The statistics of all profiled requests are added together, and
+    saved to FILENAME (in the pstats format) by dump().
+
+    """
+
+    def __init__(self, every=1, filename=None):
+        self.every = every
+        self.filename = filename
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+        self.stats = None
+
+    def run(self, func):
+        if (next(self.counter) % self.every
+                or not self.profiling.acquire(blocking=False)):
+            func()
+            return
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler, not ours, is active.
+                func()
+                return
+            try:
+                func()
+            finally:
+                profile.disable()
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+        finally:
+            self.profiling.release()
+
+    def dump(self):
+        with self.lock:
+            if self.stats is not None and self.filename:
+                self.stats.dump_stats(self.filename)
+
+
+class ChunkedWriter:
+
+    """Write to FP using the HTTP/1.1 chunked transfer coding."""
+
+    closed = False
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self.fp.write(b"%X\r\n%s\r\n" % (len(data), data))
+        return len(data)
+
+    def finish(self):
+        """Write the last (empty) chunk."""
+        self.fp.write(b"0\r\n\r\n")
+
+    def close(self):
+        # Only finish() ends the body, so that an error doesn't make a
+        # truncated body look complete.
+        pass
+
+
+class ChunkReader:
+
+    """Read-only file-like object over a sequence of byte strings."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buf + b"".join(self.chunks)
+            self.buf = b""
+            return data
+        parts = [self.buf]
+        length = len(self.buf)
+        for chunk in self.chunks:
+            parts.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                break
+        data = b"".join(parts)
+        self.buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        # Lets generators release whatever they hold (such as an
+        # os.scandir() iterator) without waiting for the GC.
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+        self.chunks = iter(())
+        self.buf = b""
+
+
+class PaddedReader:
+
+    """Reader of exactly SIZE bytes from FP.
+
+    If FP ends early, or fails, the rest is NUL bytes, and
+    ONERROR(message) is called.
+
+    >>> r = PaddedReader(BytesIO(b"abc"), 5, print)
+    >>> r.read(2), r.read(2)
+    Unexpected end of file
+    (b'ab', b'c\\x00')
+    >>> r.read(2), r.read(2)
+    (b'\\x00', b'')
+
+    """
+
+    def __init__(self, fp, size, onerror):
+        self.fp = fp
+        self.remaining = size
+        self.onerror = onerror
+        self.failed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = b""
+        if not self.failed:
+            try:
+                data = self.fp.read(size)
+            except OSError as e:
+                self.failed = True
+                self.onerror(str(e))
+            if len(data) < size and not self.failed:
+                self.failed = True
+                self.onerror("Unexpected end of file")
+        self.remaining -= size
+        return data + bytes(size - len(data))
+
+
+class DeferredBody:
+
+    """Response body produced by calling WRITETO(outputfile).
+
+    Used instead of a file object for bodies that are generated while
+    they are sent, see SimpleHTTPRequestHandler.copyfile().
+
+    """
+
+    def __init__(self, writeto):
+        self.writeto = writeto
+
+    def close(self):
+        pass
+
+
+# Formats for directory archives, and their MIME types.
+ARCHIVE_TYPES = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+    "tar.zst": "application/zstd",
+}
+
+
+class UploadRefused(ValueError):
+
+    """Raised when an upload doesn't fit in the free disk space or the
+    directory quotas; CODE is the HTTP status to reply with."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class DirectoryQuotas:
+
+    """Size limits for directory trees, from a {directory: bytes} dict.
+
+    The usage of a tree is found by walking it, and then reused for up
+    to MAX_AGE seconds, adding the uploads admitted in the meantime.
+    An admitted upload that fails still counts until the next walk.
+
+    """
+
+    def __init__(self, limits, max_age=60):
+        self.limits = {os.path.realpath(d): n for d, n in limits.items()}
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.usage = {}
+
+    def reserve(self, directory, size):
+        """Account for SIZE more bytes stored in DIRECTORY.
+
+        Return value is False, and nothing is accounted for, if that
+        would exceed the quota of any tree containing DIRECTORY.
+
+        """
+        directory = os.path.realpath(directory)
+        trees = [tree for tree in self.limits
+                 if directory == tree or
+                 directory.startswith(os.path.join(tree, ""))]
+        now = time.monotonic()
+        for tree in trees:
+            with self.lock:
+                checked = self.usage.get(tree, (None,))[0]
+            if checked is None or now - checked > self.max_age:
+                used = tree_size(tree)
+                with self.lock:
+                    self.usage[tree] = (now, used)
+        with self.lock:
+            if any(self.usage[tree][1] + size > self.limits[tree]
+                   for tree in trees):
+                return False
+            for tree in trees:
+                checked, used = self.usage[tree]
+                self.usage[tree] = (checked, used + size)
+        return True
+
+    def release(self, directory, size):
+        """Stop accounting for SIZE bytes reserved in DIRECTORY."""
+        self.reserve(directory, -size)
+
+
+def tree_size(top):
+    """Return the total size of the files in TOP and below it."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# Temporary files of AtomicFile (".NAME.XXXXXXXX.part") and of
+# ResumableUpload (".NAME.upload", and its ".idx" part index).
+TEMPORARY_NAME = re.compile(
+    r"\..+\.(?:[0-9a-f]{8}\.part|upload|upload\.idx)\Z", re.S)
+
+
+def walk_tree(top):
+    """Yield (path, archive name) pairs for TOP and everything below it.
+
+    Archive names start with the name of TOP.  Directories come before
+    their contents, and symlinks to directories are listed but not
+    followed.  Temporary files of uploads in progress are left out.
+
+    """
+    base = os.path.basename(os.path.normpath(top)) or "archive"
+    for dirpath, dirnames, filenames in os.walk(top):
+        rel = os.path.relpath(dirpath, top)
+        arcdir = base if rel == os.curdir else posixpath.join(
+            base, *rel.split(os.sep))
+        yield dirpath, arcdir
+        links = [name for name in dirnames
+                 if os.path.islink(os.path.join(dirpath, name))]
+        dirnames[:] = sorted(set(dirnames) - set(links))
+        filenames = [name for name in filenames
+                     if not TEMPORARY_NAME.match(name)]
+        for name in sorted(filenames + links):
+            yield os.path.join(dirpath, name), arcdir + "/" + name
+
+
+def scan_directory(it, since=None):
+    """Describe each entry of IT, an os.scandir() iterator, as a dict.
+
+    Entries whose mtime is not later than SINCE are skipped.  IT is
+    closed when the generator finishes or is closed.
+
+    """
+    with it:
+        for entry in it:
+            try:
+                st = entry.stat()
+            except OSError:
+                # A dangling symlink, or an entry removed meanwhile.
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+            if since is not None and st.st_mtime <= since:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                kind = "dir"
+            elif stat.S_ISREG(st.st_mode):
+                kind = "file"
+            else:
+                kind = "other"
+            yield {
+                "name": entry.name,
+                "type": kind,
+                "symlink": entry.is_symlink(),
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+            }
+
+
+def file_etag(fs, encoding=None):
+    """Return the ETag of a file with stat result FS, sent with the
+    content coding ENCODING, if any."""
+    return '"%x-%x-%x%s"' % (fs.st_ino, fs.st_size, fs.st_mtime_ns,
+                             "-" + encoding if encoding else "")
+
+
+# Compression runs while the client waits for the response, so fast
+# levels are used: the library defaults (gzip 9, brotli 11) can take
+# tens of seconds on large files for a few percent smaller output.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def compress_gzip(source, dest):
+    # No file name in the header: it would be the cache entry's.
+    with gzip.GzipFile(filename="", fileobj=dest, mode='wb',
+                       compresslevel=GZIP_LEVEL, mtime=0) as out:
+        shutil.copyfileobj(source, out)
+
+
+def compress_brotli(source, dest):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    for buf in iter(lambda: source.read(64 * 1024), b""):
+        dest.write(compressor.process(buf))
+    dest.write(compressor.finish())
+
+
+def compress_zstd(source, dest):
+    zstandard.ZstdCompressor().copy_stream(source, dest)
+
+
+# Supported content encodings, in order of preference, as
+# (encoding, file suffix, compression function) tuples.  Encodings
+# without a compression function are only served from precompressed
+# files.
+CONTENT_ENCODINGS = [
+    ("br", ".br", compress_brotli if brotli else None),
+    ("zstd", ".zst", compress_zstd if zstandard else None),
+    ("gzip", ".gz", compress_gzip),
+]
+
+
+def parse_accept_encoding(header):
+    """Parse an Accept-Encoding header into a dict of quality values.
+
+    >>> sorted(parse_accept_encoding("gzip, br;q=0.5, zstd;q=0").items())
+    [('br', 0.5), ('gzip', 1.0), ('zstd', 0.0)]
+
+    """
+    accepted = {}
+    for item in header.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, sep, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+class Thumbnailer:
+
+    """Makes JPEG previews of images, in a pool of WORKERS threads.
+
+    Previews fit in SIZE x SIZE pixels, and are kept in CACHE, a
+    CompressionCache, which keys them by path, modification time and
+    size.  Requests for an image whose preview is being made wait for
+    the same job.
+
+    """
+
+    def __init__(self, cache, size=256, workers=4):
+        self.cache = cache
+        self.size = size
+        self.suffix = ".thumb%d.jpg" % size
+        self.pool = ThreadPoolExecutor(workers,
+                                       thread_name_prefix="thumbnail")
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def get(self, path, fs):
+        """Return the name of the preview of PATH, making it if needed.
+
+        FS is the stat result of PATH.  Raises OSError (or ValueError)
+        if PATH is not an image that Pillow can read.
+
+        """
+        filename = self.cache.lookup(path, fs, self.suffix)
+        if filename is not None:
+            return filename
+        key = (path, fs.st_mtime_ns, fs.st_size)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                job = self.pool.submit(self.cache.get, path, fs,
+                                       self.suffix, self.make)
+                self.jobs[key] = job
+        job.add_done_callback(lambda job: self.forget(key, job))
+        return job.result()
+
+    def forget(self, key, job):
+        with self.lock:
+            if self.jobs.get(key) is job:
+                del self.jobs[key]
+
+    def make(self, source, dest):
+        with Image.open(source) as im:
+            # Let the JPEG decoder downscale while decoding.
+            im.draft("RGB", (self.size, self.size))
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((self.size, self.size))
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            im.save(dest, "JPEG", quality=80)
+
+
+def default_cache_dir(name):
+    """Return the default directory of the NAME cache, in the user's
+    cache directory."""
+    base = (os.environ.get("XDG_CACHE_HOME")
+            or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "SimpleHTTPWithUpload", name)
+
+
+class CompressionCache:
+
+    """Bounded on-disk cache of compressed copies of files.
+
+    Entries are keyed by path, modification time and size, so a
+    changed file gets a new entry; the stale one is eventually evicted.
+    When the total size goes over MAX_SIZE bytes, the least recently
+    used entries are removed.
+
+    Files found in DIRECTORY are served as they are, so it must belong
+    to the user running the server, and nobody else may write to it;
+    otherwise, ValueError is raised.  It is created with mode 0700.
+
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # filename -> size
+        self.total_size = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.stat(directory)
+        if not stat.S_ISDIR(st.st_mode):
+            raise ValueError("Not a directory: %s" % directory)
+        if hasattr(os, "getuid") and (st.st_uid != os.getuid()
+                                      or st.st_mode & 0o022):
+            raise ValueError("Cache directory %s must belong to you, and"
+                             " only be writable by you" % directory)
+        # Reuse what previous runs left behind, oldest first.
+        existing = [e for e in os.scandir(directory)
+                    if e.is_file() and not e.name.endswith(".tmp")]
+        existing.sort(key=lambda e: e.stat().st_mtime)
+        with self.lock:
+            for entry in existing:
+                self._add(entry.path, entry.stat().st_size)
+
+    def _add(self, filename, size):
+        self.entries[filename] = size
+        self.total_size += size
+        while self.total_size > self.max_size and len(self.entries) > 1:
+            old, old_size = self.entries.popitem(last=False)
+            self.total_size -= old_size
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def filename(self, path, fs, suffix):
+        key = "%s\0%d\0%d" % (path, fs.st_mtime_ns, fs.st_size)
+        return os.path.join(
+            self.directory,
+            hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+            + suffix)
+
+    def lookup(self, path, fs, suffix):
+        """Return the name of the cached copy of PATH, or None."""
+        filename = self.filename(path, fs, suffix)
+        with self.lock:
+            if filename in self.entries:
+                self.entries.move_to_end(filename)
+                return filename
+        return None
+
+    def get(self, path, fs, suffix, compress):
+        """Return the name of a compressed copy of PATH.
+
+        FS is the stat result of PATH.  If the copy is not cached yet,
+        it is created by calling COMPRESS(source, dest).
+
+        """
+        filename = self.lookup(path, fs, suffix)
+        if filename is not None:
+            return filename
+        filename = self.filename(path, fs, suffix)
+        # Compress without holding the lock; if two threads compress
+        # the same file at once, the last rename wins.
+        tmpname = "%s.%d.tmp" % (filename, threading.get_ident())
+        try:
+            with open(path, 'rb') as source, open(tmpname, 'wb') as dest:
+                compress(source, dest)
+            os.replace(tmpname, filename)
+        except BaseException:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        size = os.stat(filename).st_size
+        with self.lock:
+            if filename not in self.entries:
+                self._add(filename, size)
+        return filename
+
+
+def parse_byte_ranges(header, size):
+    """Parse the value of a Range header for a file of SIZE bytes.
+
+    Return None if the header is not a valid "bytes" range (and should
+    be ignored), or a sorted list of (first, last) byte positions, with
+    overlapping and adjacent ranges merged.  An empty list means none
+    of the ranges can be satisfied.
+
+    >>> parse_byte_ranges("bytes=0-99", 1000)
+    [(0, 99)]
+    >>> parse_byte_ranges("bytes=-100, 500-", 1000)
+    [(500, 999)]
+    >>> parse_byte_ranges("bytes=0-9, 20-29", 1000)
+    [(0, 9), (20, 29)]
+    >>> parse_byte_ranges("bytes=2000-", 1000)
+    []
+    >>> parse_byte_ranges("lines=1-2", 1000) is None
+    True
+
+    """
+    unit, sep, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not sep:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last):
+            return None
+        if not all(n.isdigit() for n in (first, last) if n):
+            return None
+        if not first:
+            # Suffix range: the last N bytes.
+            if int(last) == 0:
+                continue
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first = int(first)
+            if not last:
+                last = size - 1
+            elif int(last) < first:
+                return None
+            else:
+                last = min(int(last), size - 1)
+        if first > last:
+            continue
+        ranges.append((first, last))
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges):
+    """Sort (first, last) ranges, merging overlapping and adjacent ones.
+
+    >>> merge_ranges([(10, 19), (0, 9), (30, 39), (15, 25)])
+    [(0, 25), (30, 39)]
+
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def parse_content_range(header):
+    """Parse a "bytes FIRST-LAST/TOTAL" Content-Range header.
+
+    Return value is a (first, last, total) tuple.  Raises ValueError
+    if the header is malformed or the range doesn't fit in TOTAL.
+
+    >>> parse_content_range("bytes 0-1048575/5000000")
+    (0, 1048575, 5000000)
+
+    """
+    m = re.fullmatch(r"\s*bytes\s+(\d+)-(\d+)/(\d+)\s*", header, re.I)
+    if not m:
+        raise ValueError("Invalid Content-Range header")
+    first, last, total = map(int, m.groups())
+    if not first <= last < total:
+        raise ValueError("Content-Range is out of bounds")
+    return first, last, total
+
+
+class ConnectionLimitMixIn:
+
+    """Mix-in class to limit how many connections are served at once.
+
+    When max_connections requests are already being handled, the
+    accept loop blocks until one of them finishes; further clients
+    wait in the listen backlog instead of making the process grow.
+
+    """
+
+    max_connections = 64
+
+    def __init__(self, *args, max_connections=None, **kwargs):
+        if max_connections is not None:
+            self.max_connections = max_connections
+        self.connection_slots = threading.BoundedSemaphore(self.max_connections)
+        self.active_connections = 0
+        self.active_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def busy(self):
+        """Tell whether new clients have to wait for a free slot."""
+        return self.active_connections >= self.max_connections
+
+    def process_request(self, request, client_address):
+        self.connection_slots.acquire()
+        with self.active_lock:
+            self.active_connections += 1
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        # Called exactly once per request, whether it succeeded or not.
+        try:
+            super().shutdown_request(request)
+        finally:
+            with self.active_lock:
+                self.active_connections -= 1
+            self.connection_slots.release()
+
+
+class ThreadPoolMixIn:
+
+    """Mix-in class to handle each request using a fixed pool of threads."""
+
+    pool_size = 8
+
+    def __init__(self, *args, pool_size=None, **kwargs):
+        if pool_size is not None:
+            self.pool_size = pool_size
+        self.pool = ThreadPoolExecutor(self.pool_size,
+                                       thread_name_prefix="http-worker")
+        super().__init__(*args, **kwargs)
+
+    def process_request_worker(self, request, client_address):
+        """Same as in BaseServer but as a pool task."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Queue the request to be handled by the next free worker."""
+        self.pool.submit(self.process_request_worker, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class ThreadingHTTPServer(ConnectionLimitMixIn, socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+    # The default listen() backlog of 5 makes the kernel drop the SYN
+    # of a burst of new connections, which then wait a whole second to
+    # be retried.
+    request_queue_size = 128
+
+
+class ThreadPoolHTTPServer(ConnectionLimitMixIn, ThreadPoolMixIn,
+                           http.server.HTTPServer):
+    request_queue_size = 128
+
+    def busy(self):
+        """Tell whether new clients have to wait for a free worker."""
+        return self.active_connections >= self.pool_size
+
+
+class SingleHTTPServer(http.server.HTTPServer):
+    request_queue_size = 128
+
+    def busy(self):
+        """Tell whether new clients have to wait: with a single thread,
+        they always do while a connection is kept open."""
+        return True
+
+
+class PrefixedReader(io.RawIOBase):
+
+    """Raw reader returning PREFIX before the data read from RAW."""
+
+    def __init__(self, prefix, raw):
+        self.prefix = prefix
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.prefix:
+            return self.raw.readinto(b)
+        n = min(len(b), len(self.prefix))
+        b[:n] = self.prefix[:n]
+        self.prefix = self.prefix[n:]
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class SingleRequestMixIn:
+
+    """Mix-in for request handlers used by AsyncioHTTPServer.
+
+    The handler serves a single request, whose head the server has
+    already received, and leaves the connection open; its reader
+    belongs to the server, as it may already hold the beginning of the
+    next request.
+
+    Large regular files, and all of them when downloads are throttled,
+    are not sent by the handler: it leaves them in deferred_body, as a
+    (file, offset, length) tuple, for the event loop to send.  Only the
+    end of a response can be left to the loop, so multipart/byteranges
+    responses are always sent by the handler.
+
+    """
+
+    # Files up to this size are sent by the handler: they fit in the
+    # socket buffers, so even slow clients don't keep it waiting.
+    defer_size = 64 * 1024
+
+    deferred_body = None
+
+    def setup(self):
+        super().setup()
+        self.rfile.close()
+        self.rfile = self.server.connections[self.request][1]
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        # Hand a dummy reader to the base classes to close.
+        self.rfile = BytesIO()
+        super().finish()
+
+    def copyfile(self, source, outputfile, length=None):
+        """Same as in SimpleHTTPRequestHandler, but large files are
+        left for the event loop to send."""
+        try:
+            fd = source.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            fd = None
+        byteranges = getattr(self, "byteranges", None)
+        multipart = byteranges is not None and (
+            len(byteranges[0]) > 1 or byteranges[1])
+        if (outputfile is not self.wfile or fd is None or multipart
+                or not stat.S_ISREG(os.fstat(fd).st_mode)):
+            super().copyfile(source, outputfile, length)
+            return
+        offset = source.tell()
+        if length is None:
+            length = os.fstat(fd).st_size - offset
+        if length <= self.defer_size and self.download_limiter is None:
+            super().copyfile(source, outputfile, length)
+            return
+        outputfile.flush()
+        # SOURCE is closed once the handler returns.
+        self.deferred_body = (os.fdopen(os.dup(fd), "rb"), offset, length)
+        if self.counting:
+            self.count_sent(length)
+
+
+class AsyncioHTTPServer:
+
+    """HTTP server engine built around an asyncio event loop.
+
+    The event loop owns the sockets: it accepts connections, receives
+    the head of each request (and its body, if small), and waits for
+    idle (keep-alive) connections to send their next request, so slow
+    or idle clients don't cost a thread.  Once a request has arrived,
+    it is handed to a small pool of threads running the usual blocking
+    request handler for that one request; large files in the response
+    are then sent by the loop too.  Connections that don't send a
+    complete request head within idle_timeout seconds are closed.
+
+    Generated responses (directory listings, archives) and large
+    uploads are still transferred by the worker threads, so clients
+    that are slow at those do hold a worker.
+
+    The interface is a subset of the socketserver one, enough for
+    test() and the request handlers.
+
+    """
+
+    pool_size = 8
+    max_connections = 1024
+    idle_timeout = 60
+    request_queue_size = 128
+    # Heads larger than this are left for the handler to reject.
+    max_head_size = 64 * 1024
+    # Bodies up to this size are received by the loop along with the
+    # head, unless the client waits for "100 Continue".
+    max_inline_body_size = 64 * 1024
+    # Largest slice of a deferred body sent at once, each one within
+    # the handler timeout.
+    send_size = 1024 * 1024
+
+    def __init__(self, server_address, RequestHandlerClass, pool_size=None,
+                 max_connections=None):
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if max_connections is not None:
+            self.max_connections = max_connections
+        self.RequestHandlerClass = type(
+            RequestHandlerClass.__name__,
+            (SingleRequestMixIn, RequestHandlerClass), {})
+        self.socket = socket.create_server(
+            server_address, backlog=self.request_queue_size)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.pool = ThreadPoolExecutor(self.pool_size,
+                                       thread_name_prefix="http-worker")
+        self.loop = asyncio.new_event_loop()
+        self.connections = {}  # socket -> (client address, reader)
+        self.accepting = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def serve_forever(self):
+        self._start_accepting()
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        self._stop_accepting()
+        self.socket.close()
+        self.pool.shutdown(wait=True)
+        # Let the connection tasks close their sockets.
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def handle_error(self, request, client_address):
+        """Same as in BaseServer."""
+        print('-'*40, file=sys.stderr)
+        print('Exception occurred during processing of request from',
+              client_address, file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        print('-'*40, file=sys.stderr)
+
+    def _start_accepting(self):
+        if not self.accepting:
+            self.loop.add_reader(self.socket, self._accept)
+            self.accepting = True
+
+    def _stop_accepting(self):
+        if self.accepting:
+            self.loop.remove_reader(self.socket)
+            self.accepting = False
+
+    def _accept(self):
+        while len(self.connections) < self.max_connections:
+            try:
+                conn, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.log_error("accept() failed: %s", e)
+                return
+            conn.setblocking(False)
+            self.connections[conn] = (client_address, None)
+            self.loop.create_task(self._serve(conn, client_address))
+        # Too many connections; leave new ones in the listen backlog.
+        self._stop_accepting()
+
+    def _close(self, conn):
+        self.connections.pop(conn)
+        try:
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        conn.close()
+        if not self.socket._closed:
+            self._start_accepting()
+
+    async def _serve(self, conn, client_address):
+        """Serve the requests of CONN, one at a time."""
+        data = b""
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                        self._receive_request(conn, data), self.idle_timeout)
+                except (asyncio.TimeoutError, OSError):
+                    return
+                if not data:
+                    return
+                conn.setblocking(True)
+                keep_alive, data, body = await self.loop.run_in_executor(
+                    self.pool, self._process, conn, client_address, data)
+                conn.setblocking(False)
+                if body is not None:
+                    keep_alive = (await self._send_file(conn, *body)
+                                  and keep_alive)
+                if not keep_alive:
+                    return
+        finally:
+            self._close(conn)
+
+    async def _receive_request(self, conn, data):
+        """Receive the rest of the request starting with DATA.
+
+        Return all the data received, which may include the beginning
+        of the next request, or b"" if the connection was closed first.
+
+        """
+        data = bytearray(data)
+        while True:
+            size = self._request_size(data)
+            if size is not None and len(data) >= size:
+                return bytes(data)
+            received = await self.loop.sock_recv(conn, 64 * 1024)
+            if not received:
+                # The handler can still answer an incomplete body.
+                return bytes(data) if size is not None else b""
+            data += received
+
+    def _request_size(self, data):
+        """Return how much of DATA the loop should receive before
+        handing the request to a worker, or None if that is not known
+        yet.
+
+        >>> server = AsyncioHTTPServer.__new__(AsyncioHTTPServer)
+        >>> server._request_size(b"GET / HTTP/1.1\\r\\nHost: a")
+        >>> server._request_size(b"GET / HTTP/1.1\\r\\nHost: a\\r\\n\\r\\n")
+        27
+        >>> server._request_size(b"POST / HTTP/1.1\\r\\n"
+        ...                      b"Content-Length: 5\\r\\n\\r\\nab")
+        43
+        >>> server._request_size(b"PUT / HTTP/1.1\\r\\nContent-Length: 5\\r\\n"
+        ...                      b"Expect: 100-continue\\r\\n\\r\\n")
+        59
+
+        """
+        end = re.search(rb"\r?\n\r?\n", data)
+        if end is None:
+            return len(data) if len(data) > self.max_head_size else None
+        head = bytes(data[:end.end()])
+        if re.search(rb"^(expect|transfer-encoding):", head, re.I | re.M):
+            return len(head)
+        length = re.search(rb"^content-length:[ \t]*(\d+)", head, re.I | re.M)
+        if length is None or int(length[1]) > self.max_inline_body_size:
+            return len(head)
+        return len(head) + int(length[1])
+
+    def _process(self, conn, client_address, data):
+        """Handle the request at the start of DATA in a worker thread.
+
+        Return a (keep_alive, rest, body) tuple: whether the connection
+        can be kept open, the data received beyond the request, and a
+        deferred body for _send_file(), or None.
+
+        """
+        raw = PrefixedReader(data, conn.makefile("rb", buffering=0))
+        rfile = io.BufferedReader(raw)
+        self.connections[conn] = (client_address, rfile)
+        keep_alive, rest, body = False, b"", None
+        try:
+            handler = self.RequestHandlerClass(conn, client_address, self)
+            keep_alive = not handler.close_connection
+            body = handler.deferred_body
+        except Exception:
+            self.handle_error(conn, client_address)
+        if keep_alive:
+            # Keep what was read ahead, without waiting for more.
+            conn.settimeout(0)
+            try:
+                rest = rfile.peek() + raw.prefix
+            except OSError:
+                keep_alive = False
+        rfile.close()
+        return keep_alive, rest, body
+
+    async def _send_file(self, conn, f, offset, length):
+        """Send LENGTH bytes of file F, starting at OFFSET, to CONN.
+
+        Return whether they could all be sent.
+
+        """
+        handler = self.RequestHandlerClass
+        limiter = handler.download_limiter
+        client = self.connections[conn][0][0]
+        with f:
+            while length > 0:
+                count = min(length, self.send_size)
+                if limiter is not None:
+                    count = min(count, limiter.chunk_size)
+                    wait = limiter.delay(client, count)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                try:
+                    if handler.use_sendfile:
+                        sent = await asyncio.wait_for(self.loop.sock_sendfile(
+                            conn, f, offset, count), handler.timeout)
+                    else:
+                        f.seek(offset)
+                        data = f.read(count)
+                        await asyncio.wait_for(self.loop.sock_sendall(
+                            conn, data), handler.timeout)
+                        sent = len(data)
+                except (asyncio.TimeoutError, OSError):
+                    return False
+                if not sent:
+                    # The file shrank: the response is short.
+                    return False
+                offset += sent
+                length -= sent
+        return True
+
+    def log_error(self, format, *args):
+        sys.stderr.write("%s\n" % (format % args))
+
+
+def test(HandlerClass=SimpleHTTPRequestHandler,
+         ServerClass=SingleHTTPServer, port=8000, bind="", **kwargs):
+    server_address = (bind, port)
+    with ServerClass(server_address, HandlerClass, **kwargs) as httpd:
+        sa = httpd.socket.getsockname()
+        print("Serving HTTP on", sa[0], "port", sa[1], "...")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nKeyboard interrupt received, exiting.")
+            sys.exit(0)
+
+
+def parse_rate(text):
+    """Parse a rate in bytes per second, with an optional K, M or G suffix.
+
+    >>> parse_rate("512"), parse_rate("10K"), parse_rate("1.5M")
+    (512, 10240, 1572864)
+
+    """
+    return parse_size(text, "rate")
+
+
+def parse_size(text, what="size"):
+    """Parse a number of bytes, with an optional K, M or G suffix.
+
+    >>> parse_size("2G")
+    2147483648
+
+    """
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    multiplier = multipliers.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    try:
+        return int(float(text) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid %s: %r" % (what, text))
+
+
+def parse_quota(text):
+    """Parse a DIRECTORY=SIZE quota into a (directory, bytes) tuple."""
+    directory, sep, size = text.rpartition("=")
+    if not sep or not directory:
+        raise argparse.ArgumentTypeError("invalid quota: %r" % text)
+    return directory, parse_size(size)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Simple HTTP server that serves the current directory'
+        ' and accepts file uploads.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        'port',
+        nargs='?',
+        type=int,
+        default=8000,
+        help='Port to listen on'
+    )
+    parser.add_argument(
+        '-b', '--bind',
+        default='',
+        metavar='ADDRESS',
+        help='Address to bind to (default: all interfaces)'
+    )
+    parser.add_argument(
+        '-m', '--mode',
+        choices=['single', 'threaded', 'pool', 'asyncio'],
+        default='threaded',
+        help='How to handle concurrent connections: one at a time, one'
+        ' thread per connection, a fixed pool of worker threads, or an'
+        ' asyncio event loop that hands requests to a pool of workers'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=ThreadPoolMixIn.pool_size,
+        help='Number of worker threads in "pool" and "asyncio" modes'
+    )
+    parser.add_argument(
+        '-c', '--max-connections',
+        type=int,
+        help='Maximum number of open connections; %d by default, or %d in'
+        ' "asyncio" mode, where idle connections are cheap); not used in'
+        ' "single" mode' % (ConnectionLimitMixIn.max_connections,
+                           AsyncioHTTPServer.max_connections)
+    )
+    parser.add_argument(
+        '--keep-alive-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=SimpleHTTPRequestHandler.idle_timeout,
+        help='How long a persistent connection may stay idle between'
+        ' requests, holding a thread, in all modes but "asyncio"'
+    )
+    parser.add_argument(
+        '--no-sendfile',
+        action='store_false',
+        dest='use_sendfile',
+        help='Copy files through userspace buffers instead of using the'
+        ' sendfile() system call'
+    )
+    parser.add_argument(
+        '--cache-control',
+        metavar='VALUE',
+        help='Cache-Control header to send with files, such as'
+        ' "max-age=3600" or "no-cache"'
+    )
+    parser.add_argument(
+        '--fsync',
+        choices=['none', 'file', 'full'],
+        default=SimpleHTTPRequestHandler.fsync_policy,
+        help='Sync uploaded files to disk before renaming them into place'
+        ' ("file"), and also sync their directory afterwards ("full")'
+    )
+    parser.add_argument(
+        '--min-free',
+        metavar='SIZE',
+        type=parse_size,
+        default='0',
+        help='Refuse uploads (with 507) that would leave less than SIZE'
+        ' bytes free on the disk; K, M and G suffixes are accepted'
+    )
+    parser.add_argument(
+        '--quota',
+        metavar='DIR=SIZE',
+        type=parse_quota,
+        action='append',
+        default=[],
+        help='Refuse uploads (with 413) that would make the files under'
+        ' DIR exceed SIZE bytes; can be given several times'
+    )
+    parser.add_argument(
+        '--digest',
+        metavar='ALGORITHMS',
+        default='',
+        help='Comma-separated hash algorithms to compute for every'
+        ' uploaded file while it is written, such as "sha256,blake2b";'
+        ' xxh64, xxh3_64 and xxh128 need the xxhash module'
+    )
+    parser.add_argument(
+        '--upload-expiry',
+        metavar='HOURS',
+        type=float,
+        default=ResumableUpload.max_age / 3600,
+        help='Discard the parts of resumable uploads left unfinished for'
+        ' this long'
+    )
+    parser.add_argument(
+        '--archive-threads',
+        metavar='N',
+        type=int,
+        default=SimpleHTTPRequestHandler.archive_threads,
+        help='Threads used to compress ?archive=tar.zst downloads (needs'
+        ' the zstandard module); 0 or 1 compresses in the request thread'
+    )
+    for direction, verb in (('download', 'sent to'), ('upload', 'received from')):
+        parser.add_argument(
+            '--limit-%s' % direction,
+            metavar='RATE',
+            type=parse_rate,
+            default=0,
+            help='Maximum bytes per second %s all clients together, such'
+            ' as "10M"; 0 means no limit' % verb
+        )
+        parser.add_argument(
+            '--limit-%s-per-client' % direction,
+            metavar='RATE',
+            type=parse_rate,
+            default=0,
+            help='Maximum bytes per second %s each client address' % verb
+        )
+    parser.add_argument(
+        '--metrics',
+        action='store_true',
+        help='Collect metrics and serve them in the Prometheus text format'
+        ' at %s' % SimpleHTTPRequestHandler.metrics_path
+    )
+    parser.add_argument(
+        '--access-log',
+        metavar='FILE',
+        help='Write the access log as JSON lines to FILE ("-" for stderr),'
+        ' from a background thread'
+    )
+    parser.add_argument(
+        '--access-log-queue',
+        metavar='N',
+        type=int,
+        default=10000,
+        help='Number of access log records that can wait to be written;'
+        ' more are dropped (and counted) rather than slowing requests down'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        help='Profile requests with cProfile and save the statistics to'
+        ' FILE on exit (read it with "python3 -m pstats FILE")'
+    )
+    parser.add_argument(
+        '--profile-every',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Only profile one request out of every N'
+    )
+    parser.add_argument(
+        '--listing-cache',
+        metavar='N',
+        type=int,
+        default=64,
+        help='Number of rendered directory listings to keep in memory'
+    )
+    parser.add_argument(
+        '--path-cache',
+        metavar='N',
+        type=int,
+        default=4096,
+        help='Number of resolved request paths (with their MIME type and'
+        ' index page) to keep in memory'
+    )
+    parser.add_argument(
+        '--listing-page-size',
+        metavar='N',
+        type=int,
+        default=SimpleHTTPRequestHandler.listing_page_size,
+        help='Maximum number of entries per directory listing page; 0'
+        ' shows all entries in a single page'
+    )
+    parser.add_argument(
+        '--compress-cache',
+        metavar='DIR',
+        default=default_cache_dir('compressed'),
+        help='Directory where compressed copies of files are kept; it'
+        ' must be private to the user running the server'
+    )
+    parser.add_argument(
+        '--thumbnails',
+        action='store_true',
+        help='Offer a thumbnail view of directories (needs Pillow)'
+    )
+    parser.add_argument(
+        '--thumbnail-size',
+        metavar='PX',
+        type=int,
+        default=256,
+        help='Width and height of the box thumbnails fit in'
+    )
+    parser.add_argument(
+        '--thumbnail-workers',
+        metavar='N',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of threads making thumbnails'
+    )
+    parser.add_argument(
+        '--thumbnail-cache',
+        metavar='DIR',
+        default=default_cache_dir('thumbnails'),
+        help='Directory where thumbnails are kept; it must be private to'
+        ' the user running the server'
+    )
+    parser.add_argument(
+        '--thumbnail-cache-size',
+        metavar='MB',
+        type=int,
+        default=512,
+        help='Maximum size of the thumbnail cache, in megabytes'
+    )
+    parser.add_argument(
+        '--compress-cache-size',
+        metavar='MB',
+        type=int,
+        default=256,
+        help='Maximum size of the compression cache, in megabytes; 0'
+        ' disables on-the-fly compression (precompressed .gz/.br/.zst'
+        ' files are still served)'
+    )
+    parser.add_argument(
+        '--compress-max-file',
+        metavar='MB',
+        type=int,
+        default=SimpleHTTPRequestHandler.compress_max_size // (1024 * 1024),
+        help='Largest file compressed on the fly, in megabytes'
+    )
+    parser.add_argument(
+        '--content-cache-size',
+        metavar='MB',
+        type=int,
+        default=0,
+        help='Keep up to this many megabytes of small files in memory;'
+        ' 0 disables the content cache'
+    )
+    parser.add_argument(
+        '--content-cache-max-file',
+        metavar='KB',
+        type=int,
+        default=256,
+        help='Largest file kept in the content cache, in kilobytes'
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    options = parse_arguments()
+
+    HandlerClass = SimpleHTTPRequestHandler
+    HandlerClass.use_sendfile = options.use_sendfile
+    HandlerClass.idle_timeout = options.keep_alive_timeout
+    HandlerClass.cache_control = options.cache_control
+    HandlerClass.fsync_policy = options.fsync
+    HandlerClass.min_free_space = options.min_free
+    if options.quota:
+        HandlerClass.quotas = DirectoryQuotas(dict(options.quota))
+    HandlerClass.archive_threads = options.archive_threads
+    if options.limit_download or options.limit_download_per_client:
+        HandlerClass.download_limiter = RateLimiter(
+            options.limit_download, options.limit_download_per_client)
+    if options.limit_upload or options.limit_upload_per_client:
+        HandlerClass.upload_limiter = RateLimiter(
+            options.limit_upload, options.limit_upload_per_client)
+    ResumableUpload.max_age = options.upload_expiry * 3600
+    HandlerClass.digest_algorithms = [
+        name.strip().lower() for name in options.digest.split(',')
+        if name.strip()]
+    for name in HandlerClass.digest_algorithms:
+        try:
+            new_hash(name)
+        except ValueError as e:
+            sys.exit(str(e))
+    HandlerClass.listing_page_size = options.listing_page_size
+    if options.listing_cache > 0:
+        HandlerClass.listing_cache = LRUCache(options.listing_cache)
+    if options.path_cache > 0:
+        HandlerClass.path_cache = LRUCache(options.path_cache)
+    if options.content_cache_size > 0:
+        HandlerClass.content_cache = ContentCache(
+            options.content_cache_size * 1024 * 1024,
+            options.content_cache_max_file * 1024)
+    HandlerClass.compress_max_size = options.compress_max_file * 1024 * 1024
+    if options.compress_cache_size > 0:
+        try:
+            HandlerClass.compression_cache = CompressionCache(
+                options.compress_cache,
+                options.compress_cache_size * 1024 * 1024)
+        except (OSError, ValueError) as e:
+            if options.compress_cache != default_cache_dir('compressed'):
+                sys.exit("Can't use the compression cache: %s" % e)
+            print("Warning: can't use the compression cache (%s); files"
+                  " won't be compressed on the fly" % e, file=sys.stderr)
+    if options.thumbnails:
+        if Image is None:
+            sys.exit("--thumbnails needs the Pillow module:"
+                     " pip install Pillow")
+        try:
+            cache = CompressionCache(options.thumbnail_cache,
+                                     options.thumbnail_cache_size * 1024 * 1024)
+        except (OSError, ValueError) as e:
+            sys.exit("Can't use the thumbnail cache: %s" % e)
+        HandlerClass.thumbnailer = Thumbnailer(
+            cache, options.thumbnail_size, max(options.thumbnail_workers, 1))
+
+    if options.metrics:
+        HandlerClass.metrics = Metrics()
+    if options.access_log:
+        if options.access_log == '-':
+            stream = sys.stderr
+        else:
+            stream = open(options.access_log, 'a', encoding='utf-8')
+        HandlerClass.access_log = AccessLog(stream,
+                                            max(options.access_log_queue, 1))
+        atexit.register(HandlerClass.access_log.close)
+    if options.profile:
+        HandlerClass.profiler = RequestProfiler(max(options.profile_every, 1),
+                                                options.profile)
+        atexit.register(HandlerClass.profiler.dump)
+
+    kwargs = {}
+    if options.mode == 'single':
+        ServerClass = SingleHTTPServer
+    elif options.mode == 'threaded':
+        ServerClass = ThreadingHTTPServer
+        kwargs['max_connections'] = options.max_connections
+    elif options.mode == 'pool':
+        ServerClass = ThreadPoolHTTPServer
+        kwargs['max_connections'] = options.max_connections
+        kwargs['pool_size'] = options.workers
+    else:
+        ServerClass = AsyncioHTTPServer
+        kwargs['max_connections'] = options.max_connections
+        kwargs['pool_size'] = options.workers
+
+    test(HandlerClass, ServerClass, port=options.port, bind=options.bind,
+         **kwargs)
+
 
 if __name__ == '__main__':
-    test()
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+"""Load-testing benchmark and regression check for SimpleHTTPServerWithUpload.
+
+Starts the chosen server on localhost, serving a temporary directory
+filled with test files, and measures:
+
+* small: GET throughput of many small files;
+* large: streaming of a large file;
+* listing: GET of a directory listing with many entries;
+* upload: concurrent multipart POST uploads.
+
+For each scenario, it prints the number of requests and errors,
+requests per second, MB/s and the p50/p99 latency.  Responses of the
+wrong size and uploads that don't match what was sent count as errors,
+so this also works as a regression check; the exit status is 1 if
+there were any.  Extra arguments after "--" are passed to the server,
+so different engines and options can be compared against a baseline
+run, for instance:
+
+    ./SimpleHTTPServerWithUpload_benchmark.py -- --mode single
+    ./SimpleHTTPServerWithUpload_benchmark.py -- --mode asyncio
+    ./SimpleHTTPServerWithUpload_benchmark.py --server 2 --python python2
+
+where "--server 2" is the old Python 2 server, from obsolete/.
+"""
+
+import argparse
+import http.client
+import itertools
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+SCENARIOS = ['small', 'large', 'listing', 'upload']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks SimpleHTTPServerWithUpload on localhost.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-s', '--server',
+        default='3',
+        help='Server to test: "3", "2" (the old Python 2 server), or the'
+        ' path to a server script'
+    )
+    parser.add_argument(
+        '-p', '--python',
+        default=sys.executable,
+        help='Python interpreter used to run the server'
+    )
+    parser.add_argument(
+        '--scenarios',
+        default=','.join(SCENARIOS),
+        help='Comma-separated scenarios to run, out of: ' + ', '.join(SCENARIOS)
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        type=int,
+        default=8,
+        help='Number of concurrent client connections'
+    )
+    parser.add_argument(
+        '-n', '--requests',
+        type=int,
+        default=2000,
+        help='Number of requests in the "small" scenario; the other'
+        ' scenarios use fewer, relative to this'
+    )
+    parser.add_argument(
+        '--small-size',
+        type=int,
+        default=1024,
+        help='Size of each small file, in bytes'
+    )
+    parser.add_argument(
+        '--large-size',
+        type=int,
+        default=100,
+        help='Size of the large file, in megabytes'
+    )
+    parser.add_argument(
+        '--listing-entries',
+        type=int,
+        default=10000,
+        help='Number of entries in the listed directory'
+    )
+    parser.add_argument(
+        '--upload-size',
+        type=int,
+        default=10,
+        help='Size of each uploaded file, in megabytes'
+    )
+    parser.add_argument(
+        'server_args',
+        nargs='*',
+        help='Extra arguments for the server (put them after "--")'
+    )
+    args = parser.parse_args()
+    return args
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list.
+
+    >>> percentile([1, 2, 3, 4], 0.5), percentile([1, 2, 3, 4], 0.99)
+    (2, 4)
+
+    """
+    if not sorted_values:
+        return float('nan')
+    index = max(0, int(len(sorted_values) * fraction + 0.5) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_random_file(filename, size):
+    block = os.urandom(min(size, 1024 * 1024))
+    with open(filename, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def create_fixtures(root, options):
+    """Create the files served during the benchmark, inside ROOT."""
+    os.mkdir(os.path.join(root, 'small'))
+    for i in range(100):
+        write_random_file(os.path.join(root, 'small', '%03d.bin' % i),
+                          options.small_size)
+    write_random_file(os.path.join(root, 'large.bin'),
+                      options.large_size * 1024 * 1024)
+    os.mkdir(os.path.join(root, 'listing'))
+    for i in range(options.listing_entries):
+        open(os.path.join(root, 'listing', 'entry-%06d.txt' % i), 'w').close()
+    os.mkdir(os.path.join(root, 'uploads'))
+
+
+def start_server(options, root, port):
+    """Start the server in ROOT and wait until it accepts connections."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = {
+        '2': os.path.join(here, 'obsolete', 'SimpleHTTPServerWithUpload2.py'),
+        '3': os.path.join(here, 'SimpleHTTPServerWithUpload3.py'),
+    }.get(options.server, options.server)
+    command = [options.python, os.path.abspath(script)]
+    command += options.server_args + [str(port)]
+    server = subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit('The server exited: ' + ' '.join(command))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    sys.exit('The server did not start: ' + ' '.join(command))
+
+
+def run_scenario(port, concurrency, total, task):
+    """Run TOTAL calls of TASK(connection, i) over CONCURRENCY threads.
+
+    Each thread keeps its own connection, which http.client reopens
+    when the server closes it.  TASK returns the number of bytes
+    transferred.  Return value is a (latencies, nbytes, errors,
+    elapsed) tuple.
+
+    """
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+    totals = {'bytes': 0, 'errors': 0}
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            i = next(counter)
+            if i >= total:
+                break
+            start = time.perf_counter()
+            try:
+                nbytes = task(conn, i)
+            except (OSError, http.client.HTTPException, ValueError):
+                conn.close()
+                with lock:
+                    totals['errors'] += 1
+                continue
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                totals['bytes'] += nbytes
+        conn.close()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(concurrency, total))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return latencies, totals['bytes'], totals['errors'], elapsed
+
+
+def get_task(paths, size=None):
+    """Return a task that GETs PATHS in turn, expecting SIZE bytes."""
+    def task(conn, i):
+        conn.request('GET', paths[i % len(paths)])
+        response = conn.getresponse()
+        nbytes = 0
+        for data in iter(lambda: response.read(256 * 1024), b''):
+            nbytes += len(data)
+        if response.status != 200:
+            raise ValueError('HTTP status %d' % response.status)
+        if size is not None and nbytes != size:
+            raise ValueError('Got %d bytes instead of %d' % (nbytes, size))
+        return nbytes
+    return task
+
+
+def upload_task(size):
+    """Return a task that uploads SIZE random bytes as upload-N.bin.
+
+    The payload is available as the payload attribute of the task.
+
+    """
+    payload = os.urandom(size)
+    boundary = '----benchmark%s' % os.urandom(8).hex()
+
+    def task(conn, i):
+        head = ('--%s\r\nContent-Disposition: form-data; name="file";'
+                ' filename="upload-%d.bin"\r\nContent-Type:'
+                ' application/octet-stream\r\n\r\n' % (boundary, i)).encode()
+        tail = ('\r\n--%s--\r\n' % boundary).encode()
+        conn.putrequest('POST', '/uploads/')
+        conn.putheader('Content-Type',
+                       'multipart/form-data; boundary=' + boundary)
+        conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+        # As browsers do; the old Python 2 server fails without it.
+        conn.putheader('Referer', '/uploads/')
+        conn.endheaders()
+        conn.send(head)
+        conn.send(payload)
+        conn.send(tail)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200 or b'Success' not in body:
+            raise ValueError('Upload failed')
+        return size
+    task.payload = payload
+    return task
+
+
+def count_bad_uploads(directory, payload):
+    """Count the files in DIRECTORY whose contents are not PAYLOAD."""
+    bad = 0
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), 'rb') as f:
+            if f.read() != payload:
+                bad += 1
+    return bad
+
+
+def main():
+    options = parse_arguments()
+    scenarios = [name.strip() for name in options.scenarios.split(',')]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            sys.exit('Unknown scenario: ' + name)
+
+    n = options.requests
+    c = options.concurrency
+    plans = {
+        'small': (n, c, get_task(['/small/%03d.bin' % i for i in range(100)],
+                                 options.small_size)),
+        'large': (max(n // 200, c), c, get_task(['/large.bin'],
+                                                options.large_size * 1024 * 1024)),
+        'listing': (max(n // 20, c), c, get_task(['/listing/'])),
+        'upload': (max(n // 50, c), c,
+                   upload_task(options.upload_size * 1024 * 1024)),
+    }
+
+    root = tempfile.mkdtemp(prefix='SimpleHTTPServerWithUpload-benchmark-')
+    server = None
+    failed = False
+    try:
+        print('Creating test files in {0}...'.format(root))
+        create_fixtures(root, options)
+        port = free_port()
+        server = start_server(options, root, port)
+
+        print('{0:8} {1:>8} {2:>6} {3:>10} {4:>10} {5:>9} {6:>9}'.format(
+            'scenario', 'requests', 'errors', 'req/s', 'MB/s', 'p50 ms',
+            'p99 ms'))
+        for name in scenarios:
+            total, concurrency, task = plans[name]
+            latencies, nbytes, errors, elapsed = run_scenario(
+                port, concurrency, total, task)
+            if name == 'upload':
+                errors += count_bad_uploads(os.path.join(root, 'uploads'),
+                                            task.payload)
+            failed = failed or errors > 0
+            print('{0:8} {1:8d} {2:6d} {3:10.1f} {4:10.1f} {5:9.2f} {6:9.2f}'.format(
+                name, len(latencies), errors,
+                len(latencies) / elapsed,
+                nbytes / elapsed / 1024 / 1024,
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.99) * 1000,
+            ))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(root, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()